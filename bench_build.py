@@ -0,0 +1,92 @@
+'''
+Cost of building and computing expressions over thousands of small Variables
+
+Times building a sum of scaled terms over 5000 Variables of 3 bins each, and
+a chain of arithmetic on plain numbers, then computing them, and reports the
+memory held by each expression before it is computed. Computing is timed
+the first time, when the expression is planned, and at best over repeats,
+which reuse the plan (see ``_compile``). The sum is compared
+against the same arithmetic done eagerly on the DataArrays, as it was before
+operations were deferred.
+
+Usage: python bench_build.py [terms] [repeats]
+'''
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import xarray as xr
+
+import prototype
+
+
+def variables(terms):
+	return [
+		prototype.Variable(xr.DataArray(np.random.random(3), dims=['bins'], attrs={'symbol': 'x_{{{}}}'.format(i)}))
+		for i in range(terms)]
+
+
+def build(small):
+	total = 0
+	for i, v in enumerate(small):
+		total = total + (v * 2.5 + i) / 3
+	return total
+
+
+def eager(small):
+	total = 0
+	for i, v in enumerate(small):
+		total = total + (v.value * 2.5 + i) / 3
+	return total
+
+
+def scalars(terms):
+	total = prototype.Variable(0)
+	for i in range(terms):
+		total = total + (i * 0.5 - 1) * 2
+	return total
+
+
+def measure(func, repeats):
+	'''
+	Best time of ``func``, first and best times of computing its result, in 
+	seconds, and bytes allocated for its result
+	'''
+
+	best = None
+	computes = []
+	for i in range(repeats):
+		# each expression is new, so it is not in the result cache
+		start = time.perf_counter()
+		result = func()
+		built = time.perf_counter()
+		if isinstance(result, prototype.Variable):
+			result.compute()
+		computes.append(time.perf_counter() - built)
+		best = built - start if best is None else min(best, built - start)
+
+	tracemalloc.start()
+	result = func()
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	del result
+	return best, computes[0], min(computes), size
+
+
+def main(terms=5000, repeats=5):
+	small = variables(terms)
+	cases = [
+		('{} small Variables'.format(terms), lambda: build(small)),
+		('{} plain numbers'.format(terms), lambda: scalars(terms)),
+		('{} DataArrays, eagerly'.format(terms), lambda: eager(small))]
+
+	for name, func in cases:
+		seconds, first, compute, size = measure(func, repeats)
+		print('{:28} build {:7.1f} ms, compute {:7.1f} ms first, {:7.1f} ms best, {:.0f} KB'.format(
+			name, seconds * 1e3, first * 1e3, compute * 1e3, size / 1024.))
+
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
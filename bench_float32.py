@@ -0,0 +1,79 @@
+'''
+Accuracy and throughput of the float32 compute mode against float64
+
+Computes the mortality function of the demo over the API's dummy data in
+each precision, and reports the time per evaluation of mortality and of its
+mean over adm2, and the largest error of the float32 results relative to
+the float64 ones (float32 rounding is about 6e-8).
+
+Usage: python bench_float32.py [repeats]
+'''
+
+import sys
+import time
+
+import numpy as np
+
+import prototype
+
+
+def mortality(api):
+	alpha = api.get_variable('alpha')
+	gamma1 = api.get_variable('gamma1')
+	gamma2 = api.get_variable('gamma2')
+	gamma3 = api.get_variable('gamma3')
+	avg_days_per_bin = api.get_variable('avg_days_per_bin')
+	gdppc = api.get_variable('gdppc')
+	popdens = api.get_variable('popdens')
+	temp = api.get_variable('temp')
+
+	betahat = alpha + gamma1 * avg_days_per_bin + gamma2 * gdppc.ln() + gamma3 * popdens.ln()
+	return (betahat * temp).sum(dim='bins')
+
+
+def timed(build, repeats):
+	'''
+	Best time to build and compute an expression, and its result
+	'''
+
+	best = None
+	for i in range(repeats):
+		expression = build()
+		start = time.time()
+		result = expression.compute()
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, result
+
+
+def relative_error(result, reference):
+	result = result.transpose(*reference.dims).values.astype(np.float64)
+	reference = reference.values
+	return float(np.max(np.abs(result - reference)) / np.max(np.abs(reference)))
+
+
+def main(repeats=3):
+	np.random.seed(0)
+	api = prototype.ClimateImpactLabDataAPI()
+
+	results = {}
+	for dtype in prototype._DTYPES:
+		# without the result cache each repeat evaluates the expression again
+		api.configure(dtype=dtype, cache_size=0)
+		results[dtype] = (
+			timed(lambda: mortality(api), repeats),
+			timed(lambda: mortality(api).mean(dim='adm2'), repeats))
+
+	(_, mortality64), (_, mean64) = results['float64']
+	for dtype in prototype._DTYPES:
+		(seconds, result), (mean_seconds, mean) = results[dtype]
+		print('{:8} mortality {:.3f}s (error {:.1e}), mean over adm2 {:.3f}s (error {:.1e})'.format(
+			dtype,
+			seconds,
+			relative_error(result, mortality64),
+			mean_seconds,
+			relative_error(mean, mean64)))
+
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
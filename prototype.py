@@ -3,10 +3,37 @@
 # http://sites.nationalacademies.org/cs/groups/dbassesite/documents/webpage/dbasse_172599.pdf
 
 	
+import atexit
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import string
+import weakref
+from multiprocessing import shared_memory
 import xarray as xr, pandas as pd, numpy as np
 from IPython.display import display, Markdown, Latex
 
 
+# Evaluation settings, updated through ClimateImpactLabDataAPI.configure
+OPTIONS = {
+	'backend': 'numpy',
+	'chunks': None,
+	'scheduler': 'threads',
+	'threads': 1,
+	'processes': 1,
+	'cache_size': 2 ** 30,
+	'disk_cache': None,
+	'dtype': 'float64',
+}
+
+_BACKENDS = ('numpy', 'dask')
+_SCHEDULERS = ('threads', 'processes', 'synchronous')
+_DTYPES = ('float64', 'float32')
+
+
 class Variable(object):
 	'''
 	Climate Impact Lab variable class
@@ -20,14 +47,39 @@ class Variable(object):
 		Latex representation. For this example, assume we can pull 'symbol' 
 		from attrs or use string representation of data.
 
-	For math operations, this class uses the underlying 'value' attributes to do 
-	the computation. Therefore, if we configure the objects to use dask rather 
-	than in-memory, and figure out how to do the dask distributed computing, 
-	this configuration should work.
+	Math operations on Variables are deferred: each operator returns a new 
+	Variable which records the operation and its inputs, building up an 
+	expression graph. Nothing is evaluated until ``compute()`` is called (or 
+	``value`` is accessed), at which point the whole graph is planned and 
+	executed at once. If the inputs are dask-backed (see 
+	``ClimateImpactLabDataAPI.configure(backend='dask')``), the graph is 
+	handed to dask instead and computed with a local scheduler.
+
+	The dims, sizes and dtype of each result are inferred from those of the 
+	inputs as it is built (see ``sizes``, ``dtype`` and ``nbytes_estimate``), 
+	so errors such as mismatched dims are raised immediately rather than 
+	when the graph is computed.
 
 	'''
+
+	# expressions over many small Variables (e.g. a loop over regions) create 
+	# a node per operation, so nodes are kept compact
+	__slots__ = (
+		'_op', '_args', '_params', '_value', '_attrs', '_owned', '_referenced', 
+		'_key', '_varying', '_latex', '_symbolic', '_dims', '_meta')
+
 	def __init__(self, value, symbolic=None):
-		self.value=value
+		self._op = None
+		self._args = ()
+		self._params = {}
+		self._value = value
+		self._attrs = None
+		self._owned = False
+		self._referenced = False
+		self._key = None
+		self._varying = None
+		self._latex = None
+		self._meta = None
 
 		if symbolic is None:
 			if hasattr(value, 'attrs'):
@@ -38,18 +90,184 @@ class Variable(object):
 
 		self._symbolic=symbolic
 
+	@classmethod
+	def _from_op(cls, op, args, **params):
+		'''
+		Build a deferred node applying ``op`` to the Variables in ``args``
+
+		The inputs are marked as referenced, so they are no longer modified 
+		in place (see ``_inplace``). The sizes and dtype of the result are 
+		inferred from those of the inputs (see ``_infer``), so mismatched 
+		dims are reported here rather than when the graph is computed.
+
+		Operations on plain numbers only are evaluated right away, so a long 
+		chain of scalar arithmetic is a single number rather than a graph.
+		'''
+
+		if op in _ELEMENTWISE and all(a._op is None and isinstance(a._value, _NUMBERS) for a in args):
+			values = [a._value for a in args]
+			value = np.asarray(_ELEMENTWISE[op](*values))[()]
+			# plain Python numbers stay plain, so they keep promoting as 
+			# numpy's "weak" scalars do (e.g. not turning float32 into float64)
+			if not any(isinstance(v, np.generic) for v in values):
+				value = value.item()
+			return cls._scalar(value)
+
+		node = cls._derived(op, args, **params)
+		metas = [a._meta for a in node._args]
+		if None in metas:
+			_infer(node)
+		else:
+			node._meta = _infer_node(node, metas)
+		for arg in node._args:
+			arg._referenced = True
+		return node
+
+	@classmethod
+	def _derived(cls, op, args, **params):
+		'''
+		Build a node for internal use, e.g. by graph rewrites
+		'''
+
+		node = cls.__new__(cls)
+		node._op = op
+		node._args = tuple(args)
+		node._params = params
+		node._value = None
+		node._attrs = None
+		node._owned = False
+		node._referenced = False
+		node._key = None
+		node._varying = None
+		node._latex = None
+		node._symbolic = None
+		node._dims = _infer_dims(op, [a.dims for a in node._args], params)
+		node._meta = None
+		return node
+
 	def __repr__(self):
 		return self.value.__repr__()
 
+	@classmethod
+	def _scalar(cls, value):
+		'''
+		Wrap a plain number, leaving its LaTeX to be generated when needed
+		'''
+
+		node = cls.__new__(cls)
+		node._op = None
+		node._args = ()
+		node._params = {}
+		node._value = value
+		node._attrs = None
+		node._owned = False
+		node._referenced = False
+		node._key = None
+		node._varying = None
+		node._latex = None
+		node._symbolic = None
+		node._meta = (_NO_DIMS, _NO_DIMS, value)
+		return node
+
+	@staticmethod
+	def _operand(value):
+		'''
+		Whether ``value`` can be wrapped by ``_coerce``: arrays without dims 
+		would be taken for dimensionless values
+		'''
+
+		return isinstance(value, (Variable, xr.DataArray) + _NUMBERS)
+
 	@staticmethod
 	def _coerce(value):
-		if not isinstance(value, Variable):
-			return Variable(value)
-		return value
+		if isinstance(value, Variable):
+			return value
+		if isinstance(value, _NUMBERS):
+			return Variable._scalar(value)
+		return Variable(value)
+
+	@property
+	def value(self):
+		if self._value is None:
+			self.compute()
+		return self._value
+
+	@property
+	def dims(self):
+		if self._op is None:
+			return tuple(getattr(self._value, 'dims', ()))
+		return self._dims
+
+	@property
+	def sizes(self):
+		'''
+		Length of each dim of the result, inferred without computing it
+		'''
+
+		sizes = _infer(self)[0]
+		return dict((d, sizes[d]) for d in self.dims)
+
+	@property
+	def shape(self):
+		sizes = _infer(self)[0]
+		return tuple(sizes[d] for d in self.dims)
+
+	@property
+	def dtype(self):
+		return np.result_type(_infer(self)[2])
+
+	@property
+	def nbytes_estimate(self):
+		'''
+		Size of the result in bytes, inferred without computing it
+
+		Useful to check an expression before computing it, e.g. that 
+		broadcasting its inputs against each other does not produce an array 
+		larger than memory (see ``compute(max_memory=...)``).
+		'''
+
+		return int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+
+	@property
+	def key(self):
+		'''
+		Structural hash of the expression
+
+		Two Variables have the same key when they apply the same operations, 
+		with the same parameters, to the same input data, so their results 
+		can be shared (see ``_CACHE``).
+		'''
+
+		# keys are kept once computed, so the walk stops at nodes which 
+		# already have one and each node is hashed once. Keys on session 
+		# tokens dropped since by ``_new_session`` are rebuilt.
+		stack = [self]
+		while stack:
+			node = stack[-1]
+			if _current(node._key):
+				stack.pop()
+			elif node._op is None:
+				node._key = _token(node._value)
+				stack.pop()
+			else:
+				pending = [a for a in node._args if not _current(a._key)]
+				if pending:
+					stack.extend(pending)
+					continue
+				parts = [node._op, sorted(node._params.items())] + [a._key for a in node._args]
+				node._key = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+				if any(a._key.startswith('session-') for a in node._args):
+					node._key = _SESSION + node._key
+				stack.pop()
+		return self._key
 
 	@property
 	def attrs(self):
-		return self.value.attrs
+		if self._op is None:
+			return self._value.attrs
+		if self._attrs is None:
+			self._attrs = {}
+		return self._attrs
 
 	@property
 	def symbol(self):
@@ -62,92 +280,318 @@ class Variable(object):
 
 	@property
 	def symbolic(self):
+		'''
+		LaTeX for the expression
+
+		Generated from the expression graph on first access and then kept, 
+		so building expressions does not format any strings.
+		'''
+
+		if self._symbolic is None:
+			self._symbolic = _latex(self)
 		return self._symbolic
 
 
 	@symbolic.setter
 	def symbolic(self, value):
-		 self._symbolic = '{}_{{{}}}'.format(value, ','.join(self.value.dims))
+		 self._symbolic = '{}_{{{}}}'.format(value, ','.join(self.dims))
 
 
 	def __add__(self, other):
 		other = self._coerce(other)
-		return Variable(self.value + other.value, '{} + {}'.format(self.symbolic, other.symbolic))
+		return self._from_op('add', (self, other))
 
 
 	def __radd__(self, other):
 		other = self._coerce(other)
-		return Variable(other.value + self.value, '{} + {}'.format(other.symbolic, self.symbolic))
+		return self._from_op('add', (other, self))
 
 
 	def __iadd__(self, other):
-		return self.__add__(other)
+		return self._inplace('add', other)
 
 
 	def __sub__(self, other):
 		other = self._coerce(other)
-		return Variable(self.value - other.value, '{} - {}'.format(self.symbolic, other.symbolic))
+		return self._from_op('sub', (self, other))
 
 
 	def __rsub__(self, other):
 		other = self._coerce(other)
-		return Variable(other.value - self.value, '{} - {}'.format(other.symbolic, self.symbolic))
+		return self._from_op('sub', (other, self))
 
 
 	def __isub__(self, other):
-		return self.__sub__(other)
+		return self._inplace('sub', other)
 
 
 	def __mul__(self, other):
 		other = self._coerce(other)
-		return Variable(self.value * other.value, '\\left({}\\right)\\left({}\\right)'.format(self.symbolic, other.symbolic))
+		return self._from_op('mul', (self, other))
 
 
 	def __rmul__(self, other):
 		other = self._coerce(other)
-		return Variable(other.value * self.value, '\\left({}\\right)\\left({}\\right)'.format(other.symbolic, self.symbolic))
+		return self._from_op('mul', (other, self))
 
 
 	def __imul__(self, other):
-		return self.__mul__(other)
+		return self._inplace('mul', other)
 
 
 	def __div__(self, other):
 		other = self._coerce(other)
-		return Variable(self.value / other.value, '\\frac{{\\left({}\\right)}}{{\\left({}\\right)}}'.format(self.symbolic, other.symbolic))
+		return self._from_op('div', (self, other))
 
 
 	def __rdiv__(self, other):
 		other = self._coerce(other)
-		return Variable(other.value / self.value, '\\frac{{\\left({}\\right)}}{{\\left({}\\right)}}'.format(other.symbolic, self.symbolic))
+		return self._from_op('div', (other, self))
 
 
 	def __idiv__(self, other):
-		return self.__div__(other)
+		return self._inplace('div', other)
+
+	__truediv__ = __div__
+	__rtruediv__ = __rdiv__
+	__itruediv__ = __idiv__
 
 
 	def __pow__(self, other):
 		other = self._coerce(other)
-		return Variable(self.value ** other.value, '{{\\left({}\\right)}}^{{\\left({}\\right)}}'.format(self.symbolic, other.symbolic))
+		return self._from_op('pow', (self, other))
 
 
 	def __rpow__(self, other):
 		other = self._coerce(other)
-		return Variable(other.value ** self.value, '{{\\left({}\\right)}}^{{\\left({}\\right)}}'.format(other.symbolic, self.symbolic))
+		return self._from_op('pow', (other, self))
 
 
 	def __ipow__(self, other):
-		return self.__pow__(other)
+		return self._inplace('pow', other)
+
+
+	def __gt__(self, other):
+		return self._from_op('gt', (self, self._coerce(other)))
+
+
+	def __ge__(self, other):
+		return self._from_op('ge', (self, self._coerce(other)))
+
+
+	def __lt__(self, other):
+		return self._from_op('lt', (self, self._coerce(other)))
+
+
+	def __le__(self, other):
+		return self._from_op('le', (self, self._coerce(other)))
+
 
+	def __bool__(self):
+		# comparisons give deferred Variables, which must not pass as true in 
+		# ``if temp > 0:``
+		raise ValueError(
+			'The truth value of a Variable is ambiguous. Compute it, or use '
+			'np.where to choose between values elementwise.')
+
+	__nonzero__ = __bool__
+
+
+	def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+		'''
+		Defer numpy ufuncs, e.g. ``np.log(temp)`` or ``np.maximum(temp, 0)``
+
+		Calls of the ufuncs in ``_UFUNCS`` build a node like the operators 
+		do. Other ufuncs, ufunc methods such as ``np.add.reduce``, arguments 
+		such as ``out``, and operands which are plain arrays rather than 
+		Variables, DataArrays or numbers are not supported.
+		'''
+
+		op = _UFUNCS.get(ufunc)
+		if op is None or method != '__call__' or kwargs or not all(self._operand(v) for v in inputs):
+			return NotImplemented
+		return self._from_op(op, [self._coerce(v) for v in inputs])
+
+
+	def __array_function__(self, func, types, args, kwargs):
+		'''
+		Defer the numpy functions in ``_ARRAY_FUNCTIONS``, e.g. ``np.where``
+		'''
+
+		if func not in _ARRAY_FUNCTIONS or not all(self._operand(v) for v in args):
+			return NotImplemented
+		return _ARRAY_FUNCTIONS[func](*args, **kwargs)
+
+
+	def _inplace(self, op, other):
+		'''
+		Apply ``op`` with ``other``, writing into this Variable's array
+
+		Used by ``+=`` and friends, so accumulation loops reuse one array 
+		instead of allocating a new one each time. The first in-place update 
+		of an array this Variable does not own (e.g. one held by the API) 
+		copies it. The update falls back to the usual deferred operation when 
+		it cannot be done in place: when this Variable is an input to other 
+		expressions, when the result would have different dims, coordinates 
+		or dtype, or when the data is not an in-memory array.
+		'''
+
+		other = self._coerce(other)
+
+		if self._referenced or _infer_dims(op, [self.dims, other.dims], {}) != self.dims:
+			return self._from_op(op, (self, other))
+
+		value = self.compute()
+		if not isinstance(value, xr.DataArray) or _is_dask(value):
+			return self._from_op(op, (self, other))
+
+		# a kernel stops part way when missing values reach a reduction (see 
+		# ``_checked``), which must not happen while it writes into this array
+		if other._value is None and any(n._value is None and (n._op in _REDUCTIONS or n._op == 'mean') for n in _walk(other)):
+			other.compute()
+
+		if other._value is None:
+			# fuse the operand's expression with the update, so it is written 
+			# straight into this array without materializing the operand
+			update = Variable._derived(op, (self, other))
+			if update.dtype != value.dtype:
+				return self._from_op(op, (self, other))
+			root = _optimize(update)
+			if any(_is_dask(n._value) for n in _walk(root)):
+				return self._from_op(op, (self, other))
+			if not self._owned:
+				self._value = value = value.copy(deep=True)
+				self._owned = True
+			result = _execute(root, _plan(root), out=value.values)
+			if result.values is not value.values:
+				result.attrs.update(value.attrs)
+				self._value = result
+
+		else:
+			operand = other._value
+			if _is_dask(operand):
+				return self._from_op(op, (self, other))
+
+			if isinstance(operand, xr.DataArray):
+				if any(not operand.indexes[d].equals(value.indexes[d]) for d in operand.dims if d in operand.indexes):
+					return self._from_op(op, (self, other))
+				order = [d for d in self.dims if d in operand.dims]
+				operand = operand.transpose(*order).values[tuple(slice(None) if d in operand.dims else np.newaxis for d in self.dims)]
+
+			if _promote(op, value.dtype, operand.dtype if isinstance(operand, np.ndarray) else operand) != value.dtype:
+				return self._from_op(op, (self, other))
+
+			if not self._owned:
+				self._value = value = value.copy(deep=True)
+				self._owned = True
+
+			_ELEMENTWISE[op](value.values, operand, out=value.values)
+
+		# the LaTeX of the update refers to the previous LaTeX rather than 
+		# copying it, so a long accumulation loop does not rebuild the string 
+		# on every step (see ``_latex``)
+		previous = self._latex if self._op is None and self._symbolic is None else self.symbolic
+		self._latex = (op, (previous, other.symbolic), {})
+		self._symbolic = None
+		self._op = None
+		self._args = ()
+		self._params = {}
+		# the array was written to, so its content token and any copy of it 
+		# in shared memory (see ``_share``) are stale
+		_TOKENS.pop(id(self._value), None)
+		_unshare(id(value.values))
+		self._key = None
+		self._meta = None
+		return self
 
 	def sum(self, dim=None):
-		return Variable(self.value.sum(dim=dim), '\\sum{}{{\\left\\{{{}\\right\\}}}}'.format(('_{{{}}}'.format(dim) if dim is not None else ''), self.symbolic))
+		return self._from_op('sum', (self,), dim=dim)
+
+	def mean(self, dim=None):
+		return self._from_op('mean', (self,), dim=dim)
+
+	def max(self, dim=None):
+		return self._from_op('max', (self,), dim=dim)
 
 	def ln(self):
-		return Variable(np.log(self.value), '\\ln{{\\left({}\\right)}}'.format(self.symbolic))
+		return self._from_op('ln', (self,))
+
+	def replace(self, old, new=None):
+		'''
+		Return this expression with the input ``old`` replaced by ``new``
+
+		``old`` may also be a dict mapping inputs to their replacements. Parts 
+		of the expression which do not depend on the replaced inputs are 
+		shared with this one. When the result is computed, the costly parts 
+		which do not depend on them (e.g. the sums over bins of coefficients 
+		times temperature, when swapping GDP per capita) are kept in the 
+		result cache, so computing further replacements, such as a sweep over 
+		SSP runs, only recomputes what changed.
+		'''
+
+		mapping = old if isinstance(old, dict) else {old: new}
+		subs = dict((id(k), self._coerce(v)) for k, v in mapping.items())
+
+		# computed parts of the expression are looked into, so their results 
+		# are only reused where they do not depend on the replaced inputs
+		result = _rebuild(self, lambda node: subs.get(id(node)), computed=True)
+		for node in _walk(result):
+			for arg in node._args:
+				arg._referenced = True
+
+		if result is not self and result._op is not None and self._op is not None:
+			result._attrs = dict(self.attrs)
+			result._varying = set(v.key for v in subs.values()) | (self._varying or set())
+		return result
+
+	def sel(self, **indexers):
+		'''
+		Select by coordinate labels, as ``xarray.DataArray.sel``
+
+		The selection is pushed down the expression to its inputs, so only 
+		the selected part is computed: e.g. ``mortality.sel(adm2=...)`` 
+		reads one region's temperature and covariates rather than computing 
+		every region. Inputs which do not have the selected dims are shared 
+		with this expression.
+		'''
+
+		missing = [d for d in indexers if d not in self.dims]
+		if missing:
+			raise ValueError('dimensions {} do not exist'.format(missing))
+
+		result = _select(_from_cache(self), indexers)
+		for node in _walk(result):
+			for arg in node._args:
+				arg._referenced = True
+
+		if result is not self and result._op is not None and self._op is not None:
+			result._attrs = dict(self.attrs)
+			result._varying = self._varying
+		return result
+
+	def isel(self, **indexers):
+		'''
+		Select by integer position, as ``xarray.DataArray.isel``
+
+		Positions refer to the coordinates of the result, i.e. after the 
+		inputs have been aligned, and are translated to labels for ``sel``.
+		'''
+
+		missing = [d for d in indexers if d not in self.dims]
+		if missing:
+			raise ValueError('dimensions {} do not exist'.format(missing))
+
+		sizes, indexes, _ = _infer(self)
+		labels = {}
+		for dim, indexer in indexers.items():
+			index = indexes.get(dim)
+			if index is None:
+				index = pd.RangeIndex(sizes[dim])
+			labels[dim] = index[indexer]
+		return self.sel(**labels)
 
 	def get_symbol(self):
-		return self.attrs['symbol'] + '_{{{}}}'.format(','.join(self.value.dims))
+		return self.attrs['symbol'] + '_{{{}}}'.format(','.join(self.dims))
 
 	def equation(self):
 		return '{} = {}'.format(self.get_symbol(), self.symbolic)
@@ -155,75 +599,2589 @@ class Variable(object):
 	def display(self):
 		display(Latex('${}$'.format(self.equation())))
 
-	def compute(self):
+	def explain(self):
 		'''
-		right now, this just returns the value
+		Print the plan ``compute()`` would follow, without computing anything
+
+		Lists each fused kernel with the expression it evaluates, how sums of 
+		products are contracted, how it is cut into blocks, and estimates of 
+		its floating point operations and of the bytes it reads, followed by 
+		the peak memory held by results and intermediates (not counting the 
+		inputs). Estimates come from the dims and shapes of the inputs.
 		'''
 
-		return self.value
+		if self._value is not None or _CACHE.get(self.key) is not None:
+			print('Already computed')
+			return
 
-def get_random_variable(dims):
-	data = np.random.random(tuple([len(d[1]) for d in dims]))
-	foo = xr.DataArray(data, coords=dims)
-	return foo
+		root = _from_cache(self)
+		if any(_is_dask(n._value) for n in _walk(root)):
+			print('Evaluated by dask, over the chunks of its dask-backed inputs')
+			return
+		if self._varying:
+			root = _from_cache(_optimize(root))
+			steps = _plan(root, varying=self._varying)
+		else:
+			root, steps = _compile(root)
 
+		print('\n'.join(_explain(root, steps)))
 
-class ClimateImpactLabDataAPI(object):
+	def compute(self, max_memory=None):
+		'''
+		Evaluate the expression graph and return the result
+
+		The graph is planned as a whole (see ``_plan``) and executed in one 
+		pass, releasing each intermediate array as soon as its last consumer 
+		has run. The result is cached, so later calls (and ``value``) return 
+		it without recomputing. Results and intermediates are also kept in a 
+		process-wide cache keyed by ``key``, so other Variables built from 
+		the same expression reuse them, and, if ``disk_cache`` is configured, 
+		results are also saved to disk and memory-mapped back in by later 
+		sessions.
+
+		As in xarray, sums, means and maxima skip missing values (NaN). The 
+		kernels detect missing values reaching a reduction, and the 
+		expression is then evaluated with xarray operations instead, without 
+		the rewrites of ``_optimize`` and ignoring ``max_memory``.
+
+		Parameters
+		----------
+		max_memory : int or str (optional)
+			Memory budget for the result and intermediates, in bytes or as a 
+			string such as ``'16GB'``. If the graph would not fit, it is 
+			evaluated in pieces along adm2 (or another dim which is not 
+			summed over) and the pieces are stitched together. Ignored for 
+			dask-backed inputs, where memory use is set by their chunks.
+		'''
+
+		if self._value is None:
+			result = _CACHE.get(self.key)
+			if result is None:
+				result = _DISK_CACHE.get(self.key)
+				if result is not None:
+					_CACHE.put(self.key, result)
+			if result is None:
+				root = _from_cache(self)
+				try:
+					if any(_is_dask(n._value) for n in _walk(root)):
+						result = _execute_xarray(root)
+					elif max_memory is not None:
+						result = _execute_chunked(_optimize(root), _parse_bytes(max_memory))
+					elif self._varying:
+						optimized = _from_cache(_optimize(root))
+						result = _execute(optimized, _plan(optimized, varying=self._varying))
+					else:
+						result = _execute(*_compile(root))
+				except _MissingValues:
+					result = _execute_xarray(root)
+				_CACHE.put(self.key, result)
+				_DISK_CACHE.put(self.key, result)
+
+			# rewriting the graph (see ``_optimize``) can reorder the dims of 
+			# the result, and cached results may come from such graphs
+			result = _ordered(result, self.dims)
+
+			# the cache holds its own reference to the data, so the result is 
+			# shared and must be copied before any in-place update
+			if isinstance(result, xr.DataArray):
+				result = result.copy(deep=False)
+				result.attrs.update(self.attrs)
+				self._attrs = result.attrs
+			self._value = result
+			self._owned = False
+
+		return self._value
+
+	def iter_compute(self, dim='time', chunk=10):
+		'''
+		Evaluate the expression in blocks along ``dim``, yielding each block
+
+		Each block is computed from the expression graph only when it is 
+		requested, on views of the selected part of the inputs, so memory use 
+		is set by ``chunk`` rather than by the length of ``dim``. Parts of the 
+		expression which do not have ``dim`` (e.g. coefficients, or sums over 
+		time) are computed once, before the first block. Blocks are not kept 
+		in the result cache.
+
+		Parameters
+		----------
+		dim : str (optional)
+			Dim to iterate over (default ``'time'``).
+
+		chunk : int (optional)
+			Number of positions along ``dim`` in each block (default 10).
+		'''
+
+		if dim not in self.dims:
+			raise ValueError('dimensions {} do not exist'.format([dim]))
+		if int(chunk) != chunk or chunk < 1:
+			raise ValueError('chunk must be a positive integer, got {!r}'.format(chunk))
+		return _iter_blocks(self, dim, int(chunk))
+
+	def to_store(self, path, chunks=None):
+		'''
+		Evaluate the expression block by block into a chunked store on disk
+
+		The store is a zarr (format 2) directory, which can be read back with 
+		``xarray.open_dataarray(path, engine='zarr')``. It is written without 
+		holding the whole result in memory: blocks one chunk long along one 
+		of the dims are computed in turn (see ``iter_compute``), and each 
+		block's chunks are written as soon as it is computed. Chunks are 
+		stored uncompressed.
+
+		Parameters
+		----------
+		path : str
+			Directory to create for the store. It must not already exist.
+
+		chunks : dict (optional)
+			Chunk length by dim, e.g. ``{'adm2': 1000}``. Dims which are not 
+			listed are not split. By default the first dim is split into 
+			chunks of about 16MB.
+		'''
+
+		chunks = dict(chunks or {})
+		missing = [d for d in chunks if d not in self.dims]
+		if missing:
+			raise ValueError('dimensions {} do not exist'.format(missing))
+		for dim, length in chunks.items():
+			if int(length) != length or length < 1:
+				raise ValueError('chunks must be positive integers, got {!r} for {}'.format(length, dim))
+		_write_store(self, path, chunks)
+
+
+_TOKENS = {}
+_TOKEN_COUNTER = itertools.count()
+
+# Prefix of the keys built on session tokens, which changes when the tokens 
+# are dropped (see ``_new_session``)
+_SESSION = 'session-0-'
+_SESSION_COUNTER = itertools.count(1)
+
+
+def _token(value):
 	'''
-	Implements the interface for Climate Impact Lab users
+	Identity of a leaf value, for use in ``Variable.key``
+
+	Scalars are identified by value. DataArrays carrying the ``uuid`` and 
+	``updated`` fields of their database.json entry as attrs are identified 
+	by that version (and their shape and coordinates, so selections from them 
+	differ). Other arrays are identified by content if the disk cache is 
+	enabled, and otherwise by object: each gets a session token for as long 
+	as it is alive (or until it is modified in place, or the disk cache is 
+	enabled). Keys built on session tokens start with ``'session-'`` and are 
+	never persisted.
 	'''
 
-	def __init__(self, *args, **kwargs):
-		self.populate_random_data()
+	if np.ndim(value) == 0 and not isinstance(value, (xr.DataArray, np.ndarray)):
+		return repr((type(value).__name__, value))
+
+	if id(value) not in _TOKENS:
+		attrs = getattr(value, 'attrs', {})
+		digest = hashlib.sha1()
+		if 'uuid' in attrs:
+			digest.update(repr((attrs['uuid'], attrs.get('updated'))).encode('utf-8'))
+		elif OPTIONS['disk_cache'] is not None and not _is_dask(value):
+			digest.update(memoryview(np.ascontiguousarray(getattr(value, 'values', value))).cast('B'))
+		else:
+			digest = None
+
+		if digest is None:
+			token = '{}data-{}'.format(_SESSION, next(_TOKEN_COUNTER))
+		else:
+			digest.update(repr((getattr(value, 'dims', None), np.shape(value), str(value.dtype))).encode('utf-8'))
+			for index in getattr(value, 'indexes', {}).values():
+				digest.update(repr(list(index)).encode('utf-8'))
+			token = 'data-' + digest.hexdigest()
+
+		_TOKENS[id(value)] = token
+		weakref.finalize(value, _TOKENS.pop, id(value), None)
+	return _TOKENS[id(value)]
+
+
+def _current(key):
+	'''
+	Whether ``key`` is set, and not built on session tokens since dropped
+	'''
 
-	def populate_random_data(self):
-		'''
-		Provides dummy versions of the variables we need for this demo
+	return key is not None and (key.startswith(_SESSION) or not key.startswith('session-'))
 
-		This method represents work that would be done beforehand. The data in 
-		these variables should already be prepared in netCDF or csvv files. In 
-		the production version, these datasets will also be probabilistic, and 
-		climate variables will also be indexed by climate model.
-		'''
 
-		adm2 = range(1,25000)
-		bins = range(12)
-		time = range(100)
+def _new_session():
+	'''
+	Drop the session tokens, so the arrays they stand for are tokened again
 
-		self.temp = get_random_variable(dims=[('bins', bins), ('adm2', adm2), ('time', time)])
-		self.temp.attrs['symbol'] = 'T'
-		self.temp.attrs['description'] = 'NASA downscaled climate data'
+	Called when the disk cache is enabled, so arrays which were keyed before 
+	are then identified by content, and results computed from them are saved.
+	'''
 
-		self.alpha = get_random_variable(dims=[('bins', bins)])
-		self.alpha.attrs['symbol'] = '\\alpha'
+	global _SESSION
+	_SESSION = 'session-{}-'.format(next(_SESSION_COUNTER))
+	for identity, token in list(_TOKENS.items()):
+		if token.startswith('session-'):
+			_TOKENS.pop(identity, None)
 
-		self.gamma1 = get_random_variable(dims=[('bins', bins)])
-		self.gamma1.attrs['symbol'] = '{{\\gamma_1}}'
 
-		self.gamma2 = get_random_variable(dims=[('bins', bins)])
-		self.gamma2.attrs['symbol'] = '{{\\gamma_2}}'
+class _DiskCache(object):
+	'''
+	Content-addressed store of computed results under ``OPTIONS['disk_cache']``
 
-		self.gamma3 = get_random_variable(dims=[('bins', bins)])
-		self.gamma3.attrs['symbol'] = '{{\\gamma_3}}'
+	Each result is saved as ``<key>.npy`` (the data), ``<key>.coords.npz`` 
+	and ``<key>.json`` (dims and attrs), and is memory-mapped back in when 
+	requested, so results survive restarting a session and only the parts 
+	actually used are read from disk.
+	'''
 
-		self.avg_days_per_bin = get_random_variable(dims=[('bins', bins), ('adm2', adm2), ('time', time)])
-		self.avg_days_per_bin.attrs['symbol'] = 'AvgDaysPerBin'
+	def _path(self, key):
+		return os.path.join(os.path.expanduser(OPTIONS['disk_cache']), key[:2], key)
+
+	def get(self, key):
+		if OPTIONS['disk_cache'] is None or key.startswith('session-'):
+			return None
+		path = self._path(key)
+		if not os.path.exists(path + '.json'):
+			return None
+
+		with open(path + '.json') as f:
+			meta = json.load(f)
+		data = np.load(path + '.npy', mmap_mode='r')
+		with np.load(path + '.coords.npz', allow_pickle=False) as coords:
+			coords = dict((d, coords[d]) for d in coords.files)
+		return xr.DataArray(data, dims=meta['dims'], coords=coords, attrs=meta['attrs'])
+
+	def put(self, key, value):
+		if OPTIONS['disk_cache'] is None or key.startswith('session-'):
+			return
+		if not isinstance(value, xr.DataArray) or _is_dask(value):
+			return
+		path = self._path(key)
+		if os.path.exists(path + '.json'):
+			return
+
+		# coordinates are read back without unpickling, so labels held as 
+		# objects are stored as strings, and entries with other objects 
+		# (which would not come back equal) are not stored
+		coords = {}
+		for dim in value.dims:
+			if dim in value.indexes:
+				labels = np.asarray(value.indexes[dim])
+				if labels.dtype == object:
+					if not all(isinstance(label, str) for label in labels):
+						return
+					labels = labels.astype(str)
+				coords[dim] = labels
+
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+
+		# write to temporary names and rename, so a partially written entry 
+		# is never read; the json file is renamed last and marks it complete
+		tmp = '{}.{}.tmp'.format(path, os.getpid())
+		np.save(tmp + '.npy', value.values)
+		np.savez(tmp + '.coords.npz', **coords)
+		with open(tmp + '.json', 'w') as f:
+			json.dump({'dims': list(value.dims), 'attrs': _jsonable(value.attrs)}, f)
+		os.replace(tmp + '.npy', path + '.npy')
+		os.replace(tmp + '.coords.npz', path + '.coords.npz')
+		os.replace(tmp + '.json', path + '.json')
+
+
+def _jsonable(attrs):
+	return dict((k, v) for k, v in attrs.items() if isinstance(v, (str, int, float, bool)))
+
+
+_DISK_CACHE = _DiskCache()
+
+
+class _ResultCache(object):
+	'''
+	Process-wide cache of computed results, keyed by ``Variable.key``
 
-		self.gdppc = get_random_variable(dims=[('adm2', adm2), ('time', time)])
-		self.gdppc.attrs['symbol'] = 'GdpPC'
+	Least recently used entries are evicted once the cached arrays take up 
+	more than ``OPTIONS['cache_size']`` bytes.
+	'''
 
-		self.popdens = get_random_variable(dims=[('adm2', adm2), ('time', time)])
-		self.popdens.attrs['symbol'] = 'PopDensity'
+	def __init__(self):
+		self._entries = collections.OrderedDict()
+		self.nbytes = 0
 
+	def get(self, key):
+		if key not in self._entries:
+			return None
+		self._entries.move_to_end(key)
+		return self._entries[key]
 
-	def get_variable(self, varname):
-		'''
-		The actual API call. 
-		'''
+	def put(self, key, value):
+		size = getattr(value, 'nbytes', 0)
+		if key in self._entries or _is_dask(value) or size > OPTIONS['cache_size']:
+			return
+		self._entries[key] = value.copy(deep=False) if isinstance(value, xr.DataArray) else value
+		self.nbytes += size
+		self.evict(OPTIONS['cache_size'])
 
-		return Variable(self.__dict__[varname])
+	def evict(self, max_bytes):
+		while self._entries and self.nbytes > max_bytes:
+			key, value = self._entries.popitem(last=False)
+			self.nbytes -= getattr(value, 'nbytes', 0)
+
+	def clear(self):
+		self.evict(-1)
+
+
+_CACHE = _ResultCache()
+
+
+def _from_cache(root):
+	'''
+	Replace subexpressions of ``root`` which are in ``_CACHE`` by their results
+	'''
+
+	def replace(node):
+		if node._value is None:
+			cached = _CACHE.get(node.key)
+			if cached is not None:
+				leaf = Variable(cached, symbolic='')
+				leaf._key = node.key
+				return leaf
+
+	return _rebuild(root, replace)
+
+
+_FORMATS = {
+	'add': '{} + {}',
+	'sub': '{} - {}',
+	'mul': '\\left({}\\right)\\left({}\\right)',
+	'div': '\\frac{{\\left({}\\right)}}{{\\left({}\\right)}}',
+	'pow': '{{\\left({}\\right)}}^{{\\left({}\\right)}}',
+	'ln': '\\ln{{\\left({}\\right)}}',
+	'exp': '\\exp{{\\left({}\\right)}}',
+	'sqrt': '\\sqrt{{{}}}',
+	'maximum': '\\max{{\\left({}, {}\\right)}}',
+	'minimum': '\\min{{\\left({}, {}\\right)}}',
+	'gt': '{} > {}',
+	'ge': '{} \\geq {}',
+	'lt': '{} < {}',
+	'le': '{} \\leq {}',
+	'where': '\\operatorname{{where}}{{\\left({}, {}, {}\\right)}}',
+}
+
+_OPERATORS = {
+	'sum': '\\sum',
+	'mean': '\\operatorname{mean}',
+	'max': '\\max',
+}
+
+
+def _template(op, params):
+	'''
+	LaTeX format string for ``op``, with a ``{}`` for each operand
+	'''
+
+	if op in _OPERATORS:
+		dim = params.get('dim')
+		if dim is not None and not isinstance(dim, str):
+			dim = ','.join(dim)
+		operator = _OPERATORS[op].replace('{', '{{').replace('}', '}}')
+		return operator + ('_{{' + dim + '}}' if dim is not None else '') + '{{\\left\\{{{}\\right\\}}}}'
+	return _FORMATS[op]
+
+
+def _latex(root):
+	'''
+	LaTeX for the expression graph ``root``
+
+	The operands are spliced into their operations' templates in a single 
+	pass which collects the pieces and joins them once at the end, so the 
+	cost is linear in the length of the result however deeply the 
+	expression is nested. Nodes with a ``_symbolic`` (leaves, or nodes whose 
+	LaTeX was already generated or set) are used as they are.
+	'''
+
+	pieces = []
+	stack = [root]
+	while stack:
+		item = stack.pop()
+		if isinstance(item, str):
+			pieces.append(item)
+			continue
+		if isinstance(item, Variable):
+			if item._symbolic is not None:
+				pieces.append(item._symbolic)
+				continue
+			if item._op is None and item._latex is None:
+				pieces.append(str(item._value))
+				continue
+			item = item._latex or (item._op, item._args, item._params)
+
+		op, args, params = item
+		parts = []
+		operands = iter(args)
+		for literal, field, spec, conversion in string.Formatter().parse(_template(op, params)):
+			parts.append(literal)
+			if field is not None:
+				parts.append(next(operands))
+		stack.extend(reversed(parts))
+
+	return ''.join(pieces)
+
+
+# Plain numbers, which ``Variable._coerce`` wraps without further checks
+_NUMBERS = (int, float, complex, np.number)
+
+def _where(condition, x, y, out=None):
+	'''
+	``np.where``, with the ``out`` argument of the other elementwise operations
+	'''
+
+	if out is None:
+		return np.where(condition, x, y)
+	out[...] = np.where(condition, x, y)
+	return out
+
+
+_ELEMENTWISE = {
+	'add': np.add,
+	'sub': np.subtract,
+	'mul': np.multiply,
+	'div': np.true_divide,
+	'pow': np.power,
+	'ln': np.log,
+	'exp': np.exp,
+	'sqrt': np.sqrt,
+	'maximum': np.maximum,
+	'minimum': np.minimum,
+	'gt': np.greater,
+	'ge': np.greater_equal,
+	'lt': np.less,
+	'le': np.less_equal,
+	'where': _where,
+}
+
+# numpy ufuncs which ``Variable.__array_ufunc__`` defers, by operation
+_UFUNCS = dict((f, op) for op, f in _ELEMENTWISE.items() if isinstance(f, np.ufunc))
+
+
+
+def _np_where(condition, x, y):
+	return Variable._from_op('where', [Variable._coerce(v) for v in (condition, x, y)])
+
+
+def _np_reduction(op):
+	'''
+	Deferred version of the numpy reduction ``op``, with axes mapped to dims
+	'''
+
+	def reduce(a, axis=None):
+		a = Variable._coerce(a)
+		dim = None if axis is None else [a.dims[i] for i in np.atleast_1d(axis)]
+		return a._from_op(op, (a,), dim=dim)
+
+	return reduce
+
+
+# numpy functions which ``Variable.__array_function__`` defers
+_ARRAY_FUNCTIONS = {
+	np.where: _np_where,
+	np.sum: _np_reduction('sum'),
+	np.mean: _np_reduction('mean'),
+	np.max: _np_reduction('max'),
+	np.amax: _np_reduction('max'),
+}
+
+# Comparisons, which give booleans
+_COMPARISONS = ('gt', 'ge', 'lt', 'le')
+
+# Operations which give floats for integer arguments
+_FLOATING = ('div', 'ln', 'exp', 'sqrt')
+
+# Reductions which fused kernels can evaluate, by the ufunc that combines 
+# partial results. ``mean`` is rewritten into a scaled sum by ``_optimize``.
+_REDUCTIONS = {
+	'sum': np.add,
+	'max': np.maximum,
+}
+
+# Greatest depth of operations fused into one kernel
+_FUSED_DEPTH = 100
+
+# Operations which can absorb an elementwise argument into their kernel
+_FUSABLE = set(_ELEMENTWISE) | set(_REDUCTIONS)
+
+
+def _infer_dims(op, arg_dims, params):
+	'''
+	Dimensions of the result of ``op`` without evaluating it
+
+	Follows xarray's broadcasting order: the dims of the first argument, then 
+	any new dims from the following arguments in the order they appear.
+	'''
+
+	if op in _REDUCTIONS or op == 'mean':
+		dim = params.get('dim')
+		if dim is None:
+			return ()
+		reduced = [dim] if isinstance(dim, str) else list(dim)
+		return tuple(d for d in arg_dims[0] if d not in reduced)
+
+	dims = tuple(arg_dims[0])
+	for ad in arg_dims[1:]:
+		# usually the same dims, or none for a plain number
+		if ad and ad != dims:
+			dims += tuple(d for d in ad if d not in dims)
+	return dims
+
+
+def _reduced_dims(node):
+	'''
+	Dims removed by the reduction ``node``
+	'''
+
+	return tuple(d for d in node._args[0].dims if d not in node.dims)
+
+
+def _walk(root, computed=False):
+	'''
+	Nodes of an expression graph in dependency order (inputs first)
+
+	Nodes which already hold a value (leaves, or previously computed 
+	expressions) are not expanded, unless ``computed`` is True, in which 
+	case computed expressions are expanded too.
+	'''
+
+	order = []
+	seen = set()
+	stack = [(root, False)]
+	while stack:
+		node, expanded = stack.pop()
+		if expanded:
+			order.append(node)
+			continue
+		if id(node) in seen:
+			continue
+		seen.add(id(node))
+		stack.append((node, True))
+		if node._value is None or computed:
+			for arg in reversed(node._args):
+				if id(arg) not in seen:
+					stack.append((arg, False))
+
+	return order
+
+
+def _dim_sizes(root):
+	'''
+	Length of each dim appearing in an expression graph, after alignment
+
+	Each dim takes its length in the last node (in dependency order) which 
+	has it, i.e. after the inputs combined up to there are aligned (see 
+	``_infer``).
+	'''
+
+	sizes = {}
+	for node in _walk(root):
+		sizes.update(_infer(node)[0])
+	return sizes
+
+
+# Sizes and indexes of a plain number. Inferred sizes and indexes are copied 
+# before they are modified, so one empty dict is shared between numbers.
+_NO_DIMS = {}
+
+
+def _infer(root):
+	'''
+	Sizes, indexes and dtype of the result of ``root``, without evaluating it
+
+	Returns a tuple of dicts of the length and the index (if any) of each 
+	dim, and of the dtype, which for a plain number is the number itself so 
+	it takes part in type promotion as numpy would. The result is kept on 
+	each node, so only the nodes added since the last call are inferred.
+	'''
+
+	stack = [root]
+	while stack:
+		node = stack[-1]
+		if node._meta is not None:
+			stack.pop()
+			continue
+		pending = [a for a in node._args if a._meta is None] if node._value is None else []
+		if pending:
+			stack.extend(pending)
+			continue
+		stack.pop()
+		node._meta = _infer_node(node, [a._meta for a in node._args])
+	return root._meta
+
+
+def _infer_node(node, metas):
+	'''
+	Sizes, indexes and dtype of one node, from those of its inputs
+	'''
+
+	value = node._value
+	if value is not None:
+		if isinstance(value, xr.DataArray):
+			indexes = dict(value.indexes) if len(value.coords) else {}
+			return dict(zip(value.dims, value.shape)), indexes, value.dtype
+		if isinstance(value, _NUMBERS):
+			return _NO_DIMS, _NO_DIMS, value
+		return _NO_DIMS, _NO_DIMS, np.result_type(value)
+
+	if node._op in _REDUCTIONS or node._op == 'mean':
+		sizes, indexes, dtype = metas[0]
+		dim = node._params.get('dim')
+		reduced = list(sizes) if dim is None else [dim] if isinstance(dim, str) else list(dim)
+		missing = [d for d in reduced if d not in sizes]
+		if missing:
+			raise ValueError('dimensions {} do not exist'.format(missing))
+		dtype = np.result_type(dtype)
+		if node._op == 'mean':
+			dtype = np.result_type(dtype, 1.0)
+		elif node._op == 'sum' and dtype.kind == 'b':
+			dtype = np.result_type(int)
+		sizes = dict((d, n) for d, n in sizes.items() if d not in reduced)
+		indexes = dict((d, i) for d, i in indexes.items() if d not in reduced)
+		return sizes, indexes, dtype
+
+	sizes, indexes, _ = metas[0]
+	copied = False
+	for other_sizes, other_indexes, _ in metas[1:]:
+		# usually the same dims and indexes, or none for a plain number
+		if other_sizes is sizes or not other_sizes:
+			continue
+		for d, n in other_sizes.items():
+			index, other = indexes.get(d), other_indexes.get(d)
+			if d in sizes:
+				if index is not None and other is not None:
+					if index is other or index.equals(other):
+						continue
+					# inner join, as xarray aligns arithmetic operands
+					other = index.intersection(other)
+					n = len(other)
+				elif sizes[d] != n:
+					raise ValueError(
+						'cannot align dimension {!r}: sizes {} and {} differ and '
+						'not both have coordinates'.format(d, sizes[d], n))
+				elif other is None:
+					continue
+			if not copied:
+				sizes, indexes, copied = dict(sizes), dict(indexes), True
+			sizes[d] = n
+			if other is not None:
+				indexes[d] = other
+
+	if node._op == 'where':
+		return sizes, indexes, _promote('where', metas[1][2], metas[2][2])
+	return sizes, indexes, _promote(node._op, metas[0][2], metas[1][2] if len(metas) > 1 else None)
+
+
+# Result dtypes of elementwise operations, by operation and argument types
+_PROMOTIONS = {}
+
+
+def _promote(op, first, second=None):
+	'''
+	dtype of the result of the elementwise ``op``, as numpy would give it
+
+	``first`` and ``second`` are the dtypes of the arguments (``second`` is 
+	``None`` for ``ln`` and other functions of one argument, and for 
+	``where`` they are the dtypes of the two choices), or the arguments 
+	themselves for plain numbers.
+
+	Plain numbers only take part in promotion through their type (numpy's 
+	"weak" scalars), and each numpy dtype has a type of its own, so results 
+	are memoized by the types of the arguments.
+	'''
+
+	signature = (op, type(first), type(second))
+	dtype = _PROMOTIONS.get(signature)
+	if dtype is None:
+		dtype = np.result_type(first) if second is None else np.result_type(first, second)
+		if op in _COMPARISONS:
+			dtype = np.dtype(bool)
+		elif op in _FLOATING and dtype.kind in 'biu':
+			dtype = np.result_type(dtype, 1.0)
+		_PROMOTIONS[signature] = dtype
+	return dtype
+
+
+def _misaligned(order):
+	'''
+	Dims along which the inputs among the nodes ``order`` have different labels
+	'''
+
+	labels = {}
+	for node in order:
+		if isinstance(node._value, xr.DataArray):
+			for dim, size in node._value.sizes.items():
+				index = node._value.indexes.get(dim)
+				labels.setdefault(dim, set()).add(size if index is None else _index_token(index))
+	return set(dim for dim, variants in labels.items() if len(variants) > 1)
+
+
+def _optimize(root):
+	'''
+	Rewrite an expression graph into an equivalent, cheaper one
+
+	Means become sums of their argument divided by the number of elements. 
+	Sums are distributed across additions and subtractions (including sums 
+	of products with a sum among the factors) unless the inputs have 
+	different labels along the reduced dims, and factors which do not 
+	depend on the reduced dims are moved outside the sum. For the mortality function this turns
+
+		sum_b((alpha_b + gamma2_b * ln(GdpPC)) * T_b)
+
+	into ``sum_b(alpha_b * T_b) + ln(GdpPC) * sum_b(gamma2_b * T_b)``, so the 
+	low-dimensional coefficients are contracted against T directly instead 
+	of first being broadcast up to bins x adm2 x time. The input graph is 
+	left untouched; rewritten nodes are new Variables.
+	'''
+
+	memo = {}
+	order = _walk(root)
+	misaligned = _misaligned(order)
+
+	def product(factors):
+		result = factors[0]
+		for f in factors[1:]:
+			result = Variable._derived('mul', (result, f))
+		return result
+
+	def factors_of(node):
+		factors = []
+		stack = [node]
+		while stack:
+			node = stack.pop()
+			if node._value is None and node._op == 'mul':
+				stack.extend(reversed(node._args))
+			else:
+				factors.append(node)
+		return factors
+
+	def terms_of(node):
+		'''signed terms of a (possibly nested) sum of terms'''
+		terms = []
+		stack = [(1, node)]
+		while stack:
+			sign, node = stack.pop()
+			if node._value is None and node._op == 'add':
+				stack.extend([(sign, node._args[1]), (sign, node._args[0])])
+			elif node._value is None and node._op == 'sub':
+				stack.extend([(-sign, node._args[1]), (sign, node._args[0])])
+			else:
+				terms.append((sign, node))
+		return terms
+
+	def reduce(node, dims, sizes):
+		'''sum ``node`` (already rewritten) over ``dims``, of lengths ``sizes``'''
+
+		terms = terms_of(node)
+		if len(terms) == 1:
+			factors = factors_of(node)
+			for i, f in enumerate(factors):
+				if len(terms_of(f)) > 1:
+					rest = factors[:i] + factors[i + 1:]
+					terms = [(sign, product(rest + [t])) for sign, t in terms_of(f)]
+					break
+
+		# a sum of terms which are themselves sums (e.g. the mean over adm2 of 
+		# mortality) is left whole, so it is accumulated in a single pass 
+		# over the inputs rather than one pass per term
+		if len(terms) > 1 and any(f._value is None and f._op == 'sum' for sign, t in terms for f in factors_of(t)):
+			return Variable._derived('sum', (node,), dim=[d for d in dims if d in node.dims])
+
+		# summed separately, terms would not be aligned with each other along 
+		# the reduced dims
+		if len(terms) > 1 and misaligned.intersection(dims):
+			return Variable._derived('sum', (node,), dim=[d for d in dims if d in node.dims])
+
+		if len(terms) > 1:
+			result = None
+			for sign, term in terms:
+				term = reduce(term, dims, sizes)
+				if result is None:
+					result = term if sign > 0 else Variable._derived('mul', (Variable(-1), term))
+				else:
+					result = Variable._derived('add' if sign > 0 else 'sub', (result, term))
+			return result
+
+		inner = []
+		outer = []
+		for f in factors_of(node):
+			(inner if set(f.dims) & set(dims) else outer).append(f)
+
+		if inner:
+			body = product(inner)
+			summed = tuple(d for d in dims if d in body.dims)
+			outer.append(Variable._derived('sum', (body,), dim=list(summed)))
+
+		count = int(np.prod([sizes[d] for d in dims if not any(d in f.dims for f in inner)]))
+		if count != 1:
+			outer.append(Variable(count))
+
+		return product(outer)
+
+	for node in order:
+		if node._value is not None:
+			memo[id(node)] = node
+			continue
+
+		args = tuple(memo[id(a)] for a in node._args)
+		# lengths of the reduced dims after the inputs are aligned
+		if node._op == 'sum':
+			memo[id(node)] = reduce(args[0], _reduced_dims(node), _infer(node._args[0])[0])
+		elif node._op == 'mean':
+			# the division goes inside the sum, so the sum stays at the top of 
+			# its kernel and is accumulated in a single streaming pass
+			dims = _reduced_dims(node)
+			sizes = _infer(node._args[0])[0]
+			count = int(np.prod([sizes[d] for d in dims]))
+			memo[id(node)] = Variable._derived('sum', (Variable._derived('div', (args[0], Variable(count))),), dim=list(dims))
+		elif all(a is b for a, b in zip(args, node._args)):
+			memo[id(node)] = node
+		else:
+			memo[id(node)] = Variable._derived(node._op, args, **node._params)
+
+	return memo[id(root)]
+
+
+def _plan(root, varying=None):
+	'''
+	Group the nodes of an expression graph into execution steps
+
+	Chains of elementwise operations are fused into a single kernel step, 
+	so their intermediates are only ever held one block at a time. Sums are 
+	fused with the chain that produces their argument, and into the chain 
+	that consumes them, so neither the unreduced array nor the reduced one 
+	is stored. A node is materialized (becomes the output of a step) when 
+	it is the root, when it is shared by several consumers, or when it is 
+	a reduction over too many elements to fit in a single block.
+
+	Returns a list of ``(node, inputs, program, releases)`` steps in 
+	dependency order. ``program`` is the fused kernel as nested tuples of 
+	``('input', i)``, ``(reduction, dims, arg)`` and ``(op, *args)`` over 
+	``inputs``, and ``releases`` lists the inputs that are not needed by any 
+	later step and can be freed once the step has run. Nodes which already 
+	hold a value (leaves, or previously computed expressions) are inputs and 
+	are not expanded.
+
+	``varying`` is a set of keys of inputs which have been swapped out (see 
+	``Variable.replace``). Costly subexpressions which do not depend on them 
+	are also materialized, so they end up in the result cache and can be 
+	reused by the next replacement.
+	'''
+
+	order = _walk(root)
+
+	consumers = {}
+	for node in order:
+		if node._value is None:
+			for arg in node._args:
+				consumers.setdefault(id(arg), []).append(node)
+
+	# dims used by the consumers of each node, directly or further up
+	above = dict((id(node), set()) for node in order)
+	for node in reversed(order):
+		if node._value is None:
+			for arg in node._args:
+				above[id(arg)].update(above[id(node)], node.dims)
+
+	frontier = _frontier(order, varying) if varying else set()
+	misaligned = _misaligned(order)
+
+	def materialized(node):
+		if node is root or node._value is not None or node._op not in _FUSABLE:
+			return True
+		if id(node) in frontier or id(node) in cut:
+			return True
+		if node._op in _REDUCTIONS and np.prod([_infer(node._args[0])[0][d] for d in _reduced_dims(node)]) > _BLOCK_SIZE:
+			return True
+		# a sum over a dim which is also used further up (e.g. x + x.sum('adm2')) 
+		# must not share that axis with the rest of the kernel, where inputs 
+		# are aligned along it
+		if node._op in _REDUCTIONS and above[id(node)].intersection(_reduced_dims(node)):
+			return True
+		# inputs are aligned across a whole kernel, so reductions over a dim 
+		# along which they differ (e.g. sum(A) + sum(B) where A and B cover 
+		# different regions) must each align only the inputs they reduce
+		if node._op in _REDUCTIONS and misaligned.intersection(_reduced_dims(node)):
+			return True
+		users = consumers.get(id(node), [])
+		return len(users) != 1 or users[0]._op not in _FUSABLE
+
+	# long chains (e.g. a sum built up over thousands of regions) are cut 
+	# into several kernels, as programs are evaluated recursively
+	cut = set()
+	depth = {}
+	for node in order:
+		if node._value is not None:
+			continue
+		depth[id(node)] = 1 + max([depth[id(a)] for a in node._args if not materialized(a)] or [0])
+		if depth[id(node)] > _FUSED_DEPTH:
+			cut.add(id(node))
+			depth[id(node)] = 0
+
+	steps = []
+	for node in order:
+		if node._value is not None or not materialized(node):
+			continue
+
+		inputs = []
+		positions = {}
+
+		def build(n):
+			if n is not node and materialized(n):
+				if id(n) not in positions:
+					positions[id(n)] = len(inputs)
+					inputs.append(n)
+				return ('input', positions[id(n)])
+			if n._op in _REDUCTIONS:
+				return (n._op, _reduced_dims(n), build(n._args[0]))
+			return (n._op,) + tuple(build(a) for a in n._args)
+
+		steps.append((node, inputs, build(node), []))
+
+	last_use = {}
+	for i, (node, inputs, program, releases) in enumerate(steps):
+		for arg in inputs:
+			last_use[id(arg)] = i
+
+	for i, (node, inputs, program, releases) in enumerate(steps):
+		releases.extend(a for a in inputs if last_use[id(a)] == i and a._value is None)
+
+	return steps
+
+
+# Plans made by ``_compile``, by the structure of the expression
+_PLANS = collections.OrderedDict()
+_PLAN_CACHE_SIZE = 256
+
+
+def _signature(order):
+	'''
+	Structure of the expression graph ``order`` (as from ``_walk``)
+
+	Graphs with the same signature apply the same operations to inputs with 
+	the same dims, shapes, dtypes and coordinates, so they are optimized and 
+	planned the same way (e.g. with the same counts of aligned elements in 
+	means), whatever the data.
+	'''
+
+	index = {}
+	parts = []
+	for node in order:
+		index[id(node)] = len(parts)
+		if node._value is not None:
+			value = node._value
+			dtype = getattr(value, 'dtype', None)
+			indexes = getattr(value, 'indexes', {})
+			coords = tuple((d, _index_token(indexes[d])) for d in getattr(value, 'dims', ()) if d in indexes)
+			parts.append(('input', tuple(getattr(value, 'dims', ())), np.shape(value), str(dtype) if dtype is not None else type(value).__name__, coords))
+		else:
+			params = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in node._params.items()))
+			parts.append((node._op, params, tuple(index[id(a)] for a in node._args)))
+	return tuple(parts)
+
+
+# Tokens of the indexes of inputs, by id, for signatures. Inputs from the 
+# API share their index objects, so each is hashed once.
+_INDEX_TOKENS = {}
+
+
+def _index_token(index):
+	token = _INDEX_TOKENS.get(id(index))
+	if token is None or token[0] is not index:
+		if len(_INDEX_TOKENS) >= _PLAN_CACHE_SIZE:
+			_INDEX_TOKENS.clear()
+		token = _INDEX_TOKENS[id(index)] = (index, repr(_indexer_token(np.asarray(index))))
+	return token[1]
+
+
+class _Plan(object):
+	'''
+	An optimized and planned expression graph, without its input data
+
+	The optimized graph is recorded as instructions over the positions of 
+	the inputs of the original graph, and the steps of ``_plan`` over 
+	positions in the optimized graph, so both can be rebuilt for new inputs 
+	without optimizing or planning again.
+	'''
+
+	def __init__(self, inputs, root, steps):
+		position = dict((id(node), i) for i, node in enumerate(inputs))
+		index = {}
+		self.nodes = []
+		for node in _walk(root):
+			index[id(node)] = len(self.nodes)
+			if id(node) in position:
+				self.nodes.append(('input', position[id(node)]))
+			elif node._value is not None:
+				# a constant introduced by ``_optimize``, e.g. a count of elements
+				self.nodes.append(('constant', node))
+			else:
+				self.nodes.append((node._op, node._params, tuple(index[id(a)] for a in node._args)))
+
+		self.steps = [
+			(index[id(node)], [index[id(a)] for a in args], program, [index[id(a)] for a in releases])
+			for node, args, program, releases in steps]
+
+	def bind(self, inputs):
+		'''
+		The optimized graph and its steps for new ``inputs``
+		'''
+
+		nodes = []
+		for instruction in self.nodes:
+			if instruction[0] == 'input':
+				nodes.append(inputs[instruction[1]])
+			elif instruction[0] == 'constant':
+				nodes.append(instruction[1])
+			else:
+				op, params, args = instruction
+				nodes.append(Variable._derived(op, [nodes[i] for i in args], **params))
+
+		steps = [
+			(nodes[node], [nodes[i] for i in args], program, [nodes[i] for i in releases])
+			for node, args, program, releases in self.steps]
+		return nodes[-1], steps
+
+
+def _compile(root):
+	'''
+	Optimize and plan ``root``, returning the optimized graph and its steps
+
+	Plans are cached by ``_signature``, so evaluating the same formula over 
+	and over with different data (per climate model, SSP or draw) only binds 
+	the new inputs to the plan made the first time.
+	'''
+
+	order = _walk(root)
+	inputs = [node for node in order if node._value is not None]
+	signature = _signature(order)
+
+	plan = _PLANS.get(signature)
+	if plan is None:
+		optimized = _optimize(root)
+		plan = _PLANS[signature] = _Plan(inputs, optimized, _plan(optimized))
+		if len(_PLANS) > _PLAN_CACHE_SIZE:
+			_PLANS.popitem(last=False)
+	else:
+		_PLANS.move_to_end(signature)
+
+	return plan.bind(inputs)
+
+
+def _frontier(order, varying):
+	'''
+	Subexpressions worth keeping when the ``varying`` inputs are swapped
+
+	These are the largest subexpressions which do not depend on ``varying`` 
+	but feed into ones that do, and which are cheaper to store than to 
+	recompute: they contain a reduction or a transcendental function, and 
+	their result is no larger than the inputs they read. Where a candidate 
+	is not worth keeping, its arguments are considered instead.
+	'''
+
+	depends = {}
+	leaves = {}
+	costly = {}
+	for node in order:
+		if node._value is not None:
+			depends[id(node)] = node.key in varying
+			leaves[id(node)] = {id(node): getattr(node._value, 'nbytes', 0)}
+			costly[id(node)] = False
+			continue
+		depends[id(node)] = node.key in varying or any(depends[id(a)] for a in node._args)
+		leaves[id(node)] = {}
+		for a in node._args:
+			leaves[id(node)].update(leaves[id(a)])
+		costly[id(node)] = node._op in ('ln', 'pow', 'exp') or node._op in _REDUCTIONS or any(costly[id(a)] for a in node._args)
+
+	def worth(node):
+		nbytes = int(np.prod(list(_infer(node)[0].values()))) * 8
+		return costly[id(node)] and nbytes <= sum(leaves[id(node)].values())
+
+	frontier = set()
+	candidates = [a for n in order if n._value is None and depends[id(n)] for a in n._args if not depends[id(a)]]
+	while candidates:
+		node = candidates.pop()
+		if node._value is not None or id(node) in frontier:
+			continue
+		if worth(node):
+			frontier.add(id(node))
+		else:
+			candidates.extend(node._args)
+
+	return frontier
+
+
+_OPERATOR_SYMBOLS = {
+	'add': '+', 'sub': '-', 'mul': '*', 'div': '/', 'pow': '**', 
+	'gt': '>', 'ge': '>=', 'lt': '<', 'le': '<='}
+
+
+def _describe(program, names):
+	'''
+	Readable form of a fused ``program`` over inputs called ``names``
+	'''
+
+	def describe(program, nested):
+		if program[0] == 'input':
+			return names[program[1]]
+		if program[0] in _REDUCTIONS:
+			return '{}[{}]({})'.format(program[0], ','.join(program[1]), describe(program[2], False))
+		if program[0] in _OPERATOR_SYMBOLS:
+			text = ' {} '.format(_OPERATOR_SYMBOLS[program[0]]).join(describe(p, True) for p in program[1:])
+			return '({})'.format(text) if nested else text
+		return '{}({})'.format(program[0], ', '.join(describe(p, False) for p in program[1:]))
+
+	return describe(program, False)
+
+
+def _estimate(program, present, layout, sizes):
+	'''
+	Floating point operations to evaluate ``program`` once over ``sizes``
+
+	Each elementwise operation and each element summed counts once, except 
+	that the multiply-adds of a contraction count twice. Also returns a 
+	description of each contraction, giving the dims of its operands.
+	'''
+
+	def subscripts(dims):
+		return '({})'.format(','.join(d for d in layout if d in dims))
+
+	def size(dims):
+		return int(np.prod([sizes.get(d, 1) for d in dims]))
+
+	flops = 0
+	contractions = []
+	memo = {}
+	stack = [program]
+	while stack:
+		node = stack.pop()
+		if node[0] == 'input':
+			continue
+		if node[0] == 'sum' and node[2][0] == 'mul':
+			operands, products = _grouped(node[2], present, layout, [sizes.get(d, 1) for d in layout])
+			flops += 2 * size(set().union(*operands)) + sum(size(p) for p in products)
+			contractions.append('{} over {}: {} -> {}'.format(
+				'einsum', 
+				','.join(node[1]), 
+				' x '.join(subscripts(o) for o in operands), 
+				subscripts(_program_dims(node, present, memo))))
+			stack.extend(_factors(node[2]))
+		elif node[0] in _REDUCTIONS:
+			flops += size(_program_dims(node[2], present, memo))
+			stack.append(node[2])
+		else:
+			flops += size(_program_dims(node, present, memo))
+			stack.extend(node[1:])
+
+	return flops, contractions
+
+
+def _explain(root, steps):
+	'''
+	Lines describing the steps of ``_plan`` for ``root`` (see ``explain``)
+	'''
+
+	if not steps:
+		return ['Already computed']
+
+	itemsize = max([np.dtype(getattr(n._value, 'dtype', float)).itemsize for n in _walk(root) if n._value is not None] or [8])
+
+	def nbytes(node):
+		if node._value is not None:
+			return getattr(node._value, 'nbytes', 0)
+		return int(np.prod(list(_infer(node)[0].values()))) * itemsize
+
+	def shape(node):
+		sizes = _infer(node)[0]
+		return '({})'.format(', '.join('{}: {}'.format(d, sizes[d]) for d in node.dims))
+
+	outputs = dict((id(node), i + 1) for i, (node, inputs, program, releases) in enumerate(steps))
+	leaves = [n for n in _walk(root) if n._value is not None and getattr(n._value, 'nbytes', 0)]
+	lines = ['{} kernel(s) over {} input(s) ({})'.format(len(steps), len(leaves), _format_bytes(sum(nbytes(n) for n in leaves)))]
+
+	live = 0
+	peak = 0
+	total_flops = 0
+	for i, (node, inputs, program, releases) in enumerate(steps):
+		names = []
+		for j, arg in enumerate(inputs):
+			if id(arg) in outputs:
+				names.append('kernel{}'.format(outputs[id(arg)]))
+			elif arg._value is not None and not hasattr(arg._value, 'dims'):
+				names.append(str(arg._value))
+			else:
+				symbol = arg._value.attrs.get('symbol') if arg._value is not None else None
+				names.append(symbol or 'input{}'.format(j))
+
+		# inputs are aligned within each kernel, over the dims it reduces too
+		sizes = _dim_sizes(node)
+		present = [set(a.dims) for a in inputs]
+		layout = _layout(program, node.dims)
+		extent = tuple(sizes.get(d, 1) for d in layout)
+		kept, accumulate, spanned, order = _schedule(program, present, layout, node.dims, extent)
+		blocks = list(_blocks(extent, _block_size(program, present, layout, extent), order=order, whole=spanned))
+		block = blocks[0]
+		flops, contractions = _estimate(program, present, layout, sizes)
+		total_flops += flops
+
+		lines.append('')
+		lines.append('kernel{} -> {} {}'.format(i + 1, shape(node), _format_bytes(nbytes(node))))
+		lines.append('  ' + _describe(program, names))
+		for contraction in contractions:
+			lines.append('  contraction: ' + contraction)
+		lines.append('  blocks: {} of ({}){}'.format(
+			len(blocks), 
+			', '.join('{}: {}'.format(layout[a], len(range(*block[a].indices(extent[a])))) for a in order), 
+			', accumulated over ' + ','.join(layout[a] for a in accumulate) if accumulate else ''))
+		lines.append('  estimated: {:.3g} FLOPs, {} read'.format(flops, _format_bytes(sum(nbytes(a) for a in inputs))))
+
+		live += nbytes(node)
+		peak = max(peak, live)
+		live -= sum(nbytes(a) for a in releases)
+
+	lines.append('')
+	lines.append('Total: {:.3g} FLOPs, peak memory {} for results and intermediates'.format(total_flops, _format_bytes(peak)))
+	return lines
+
+
+def _execute(root, steps, out=None, cache=True):
+	'''
+	Run the steps produced by ``_plan`` and return the value of ``root``
+
+	If given, ``out`` is an array for the final step to write into (see 
+	``_run_fused``). Intermediate results are added to ``_CACHE`` unless 
+	``cache`` is False.
+	'''
+
+	if root._value is not None:
+		return root._value
+
+	results = {}
+
+	def fetch(node):
+		if node._value is not None:
+			return node._value
+		return results[id(node)]
+
+	for node, inputs, program, releases in steps:
+		results[id(node)] = _run_fused(program, [fetch(a) for a in inputs], node.dims, out=out if node is root else None)
+		if cache and node is not root:
+			_CACHE.put(node.key, results[id(node)])
+
+		for arg in releases:
+			results.pop(id(arg), None)
+
+	return results[id(root)]
+
+
+def _rebuild(root, replace, computed=False):
+	'''
+	Copy an expression graph, substituting nodes for which ``replace`` 
+	returns a Variable (``replace`` returns ``None`` to keep a node)
+
+	Nodes whose inputs are all unchanged are reused rather than copied. If 
+	``computed`` is True, expressions which were already computed are 
+	looked into as well, and copied without their value if any of their 
+	inputs changed.
+	'''
+
+	memo = {}
+	for node in _walk(root, computed):
+		new = replace(node)
+		if new is None and (node._value is None or computed) and node._op is not None:
+			args = tuple(memo[id(a)] for a in node._args)
+			if not all(a is b for a, b in zip(args, node._args)):
+				new = Variable._derived(node._op, args, **node._params)
+		memo[id(node)] = node if new is None else new
+
+	return memo[id(root)]
+
+
+def _indexer_token(indexer):
+	'''
+	Hashable description of a ``sel`` indexer, for keys of selected inputs
+	'''
+
+	if isinstance(indexer, slice):
+		return repr(indexer)
+	array = np.asarray(indexer)
+	if array.dtype == object:
+		return repr(array.tolist())
+	return [str(array.dtype), array.shape, hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()]
+
+
+def _select(root, indexers):
+	'''
+	Copy an expression graph with ``indexers`` applied to its inputs
+
+	Each node passes on the indexers for the dims it has, so dims which are 
+	summed over below it are left whole. Inputs are selected eagerly (this 
+	is usually a view), and keyed by their original key and the indexers, so 
+	the result cache recognizes the same selection made again.
+	'''
+
+	order = _walk(root)
+
+	# the dims each node is selected along, by each of its consumers
+	requests = dict((id(node), set()) for node in order)
+	requests[id(root)].add(tuple(d for d in root.dims if d in indexers))
+	for node in reversed(order):
+		if node._value is None:
+			for dims in requests[id(node)]:
+				for arg in node._args:
+					requests[id(arg)].add(tuple(d for d in dims if d in arg.dims))
+
+	memo = {}
+	for node in order:
+		for dims in requests[id(node)]:
+			if not dims:
+				new = node
+			elif node._value is not None:
+				chosen = dict((d, indexers[d]) for d in dims)
+				new = Variable(node._value.sel(**chosen), symbolic=node.symbolic)
+				# the selection is usually a view, and its key is built from 
+				# the input's current contents, so the input must not be 
+				# updated in place from now on (see ``Variable._inplace``)
+				node._referenced = True
+				key = node.key
+				new._key = hashlib.sha1(repr(['sel', sorted((d, _indexer_token(i)) for d, i in chosen.items()), key]).encode('utf-8')).hexdigest()
+				if key.startswith('session-'):
+					new._key = _SESSION + new._key
+			else:
+				args = tuple(memo[(id(a), tuple(d for d in dims if d in a.dims))] for a in node._args)
+				new = Variable._derived(node._op, args, **node._params)
+			memo[(id(node), dims)] = new
+
+	return memo[(id(root), tuple(d for d in root.dims if d in indexers))]
+
+
+def _iter_blocks(variable, dim, chunk):
+	'''
+	Generator behind ``Variable.iter_compute``
+	'''
+
+	sizes, indexes, _ = _infer(variable)
+	index = indexes.get(dim)
+
+	def piece(start):
+		# slices select views of the inputs, where arrays of labels would 
+		# copy them
+		if index is None:
+			return slice(start, start + chunk)
+		if index.is_monotonic_increasing and index.is_unique:
+			return slice(index[start], index[min(start + chunk, len(index)) - 1])
+		return index[start:start + chunk]
+
+	value = variable._value
+	if value is None:
+		value = _CACHE.get(variable.key)
+	if value is not None:
+		value = _ordered(value, variable.dims)
+		for start in range(0, sizes[dim], chunk):
+			yield value.isel({dim: slice(start, start + chunk)})
+		return
+
+	root = _from_cache(variable)
+	for node in _walk(root):
+		if node._value is None and dim in node.dims:
+			for arg in node._args:
+				if arg._value is None and dim not in arg.dims:
+					arg.compute()
+
+	dask = any(_is_dask(n._value) for n in _walk(root))
+	for start in range(0, sizes[dim], chunk):
+		block = _select(root, {dim: piece(start)})
+		if dask:
+			result = _execute_xarray(block)
+		else:
+			try:
+				result = _execute(*_compile(block), cache=False)
+			except _MissingValues:
+				result = _execute_xarray(block)
+		result = _ordered(result, variable.dims)
+		if isinstance(result, xr.DataArray):
+			result = result.copy(deep=False)
+			result.attrs.update(variable.attrs)
+		yield result
+
+
+# Name of the data in a store written by ``Variable.to_store``, which is the 
+# name xarray gives an unnamed DataArray, so the store opens as a DataArray
+_STORE_NAME = '__xarray_dataarray_variable__'
+
+# Default size of the chunks of a store, in bytes
+_STORE_CHUNK = 2 ** 24
+
+
+def _write_store(variable, path, chunks):
+	'''
+	Write the result of ``variable`` to a zarr store at ``path``, by blocks
+	'''
+
+	dims = variable.dims
+	sizes, indexes, dtype = _infer(variable)
+	dtype = np.result_type(dtype)
+	shape = [sizes[d] for d in dims]
+	if not chunks and dims:
+		row = int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize
+		chunks = {dims[0]: max(1, _STORE_CHUNK // max(row, 1))}
+	chunks = [max(1, min(chunks.get(d, sizes[d]), sizes[d])) for d in dims]
+
+	os.makedirs(path)
+	_write_json(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+	_write_json(os.path.join(path, '.zattrs'), {})
+
+	for dim in dims:
+		if dim in indexes:
+			labels = np.asarray(indexes[dim])
+			if labels.dtype == object:
+				labels = labels.astype(str)
+			array = os.path.join(path, dim)
+			_write_zarr_array(array, labels.shape, [max(1, len(labels))], labels.dtype, {'_ARRAY_DIMENSIONS': [dim]})
+			_write_chunk(os.path.join(array, '0'), labels, [max(1, len(labels))], labels.dtype)
+
+	attrs = _jsonable(variable.attrs)
+	attrs['_ARRAY_DIMENSIONS'] = list(dims)
+	array = os.path.join(path, _STORE_NAME)
+	_write_zarr_array(array, shape, chunks, dtype, attrs)
+
+	if not dims:
+		_write_chunk(os.path.join(array, '0'), np.asarray(variable.compute()), [], dtype)
+		return
+
+	# the blocks are computed along the dim which makes them smallest
+	axis = min(range(len(dims)), key=lambda i: chunks[i] / float(max(shape[i], 1)))
+	for position, block in enumerate(_iter_blocks(variable, dims[axis], chunks[axis])):
+		values = block.transpose(*dims).values
+		grid = [[0] if i == axis else range(0, n, chunks[i]) for i, n in enumerate(values.shape)]
+		for starts in itertools.product(*grid):
+			piece = values[tuple(slice(start, start + chunk) for start, chunk in zip(starts, chunks))]
+			name = '.'.join(str(position if i == axis else start // chunks[i]) for i, start in enumerate(starts))
+			_write_chunk(os.path.join(array, name), piece, chunks, dtype)
+
+
+def _write_json(path, content):
+	with open(path, 'w') as f:
+		json.dump(content, f)
+
+
+def _write_zarr_array(path, shape, chunks, dtype, attrs):
+	'''
+	Create the directory and metadata of an uncompressed zarr array
+	'''
+
+	os.makedirs(path)
+	_write_json(os.path.join(path, '.zarray'), {
+		'zarr_format': 2,
+		'shape': list(shape),
+		'chunks': list(chunks),
+		'dtype': np.dtype(dtype).str,
+		'compressor': None,
+		'fill_value': None,
+		'order': 'C',
+		'filters': None,
+	})
+	_write_json(os.path.join(path, '.zattrs'), attrs)
+
+
+def _write_chunk(path, values, chunks, dtype):
+	'''
+	Write one chunk of a zarr array, padding it to full size at the edges
+	'''
+
+	if values.shape != tuple(chunks):
+		padded = np.zeros(chunks, dtype=dtype)
+		padded[tuple(slice(0, n) for n in values.shape)] = values
+		values = padded
+	with open(path, 'wb') as f:
+		f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+
+_BYTE_UNITS = {'B': 1, 'KB': 2 ** 10, 'MB': 2 ** 20, 'GB': 2 ** 30, 'TB': 2 ** 40}
+
+
+def _format_bytes(size):
+	'''
+	Convert a number of bytes to a string such as ``'1.5GB'``
+	'''
+
+	for unit in ('TB', 'GB', 'MB', 'KB'):
+		if size >= _BYTE_UNITS[unit]:
+			return '{:.1f}{}'.format(size / float(_BYTE_UNITS[unit]), unit)
+	return '{}B'.format(int(size))
+
+
+def _parse_bytes(size):
+	'''
+	Convert a memory size such as ``16e9`` or ``'16GB'`` to a number of bytes
+	'''
+
+	if isinstance(size, str):
+		text = size.strip().upper()
+		for unit in sorted(_BYTE_UNITS, key=len, reverse=True):
+			if text.endswith(unit):
+				return int(float(text[:-len(unit)]) * _BYTE_UNITS[unit])
+		return int(float(text))
+	return int(size)
+
+
+def _execute_chunked(root, max_memory):
+	'''
+	Evaluate ``root`` in pieces so its intermediates fit in ``max_memory``
+
+	The graph is split along the largest output dim that is not reduced 
+	anywhere in it (typically adm2, otherwise time). Each piece evaluates 
+	the whole graph on views of the inputs, and the results are written into 
+	a single preallocated output. The output itself, and any intermediates 
+	which do not have the split dim, must fit within the budget. The budget 
+	does not count the inputs, nor the few cache-sized blocks each kernel 
+	works on at a time.
+	'''
+
+	order = _walk(root)
+	sizes = _infer(root)[0]
+	itemsize = max([np.dtype(getattr(n._value, 'dtype', float)).itemsize for n in order if n._value is not None] or [8])
+
+	# sizes are those after alignment, which is what each piece computes
+	def nbytes(node):
+		return int(np.prod(list(_infer(node)[0].values()))) * itemsize
+
+	reduced = set(d for n in order if n._value is None and n._op in _REDUCTIONS for d in _reduced_dims(n))
+	candidates = [d for d in root.dims if d not in reduced]
+
+	steps = _plan(root)
+	fixed = nbytes(root)
+	if fixed > max_memory:
+		raise MemoryError(
+			'result requires {} bytes, more than max_memory ({} bytes)'.format(fixed, max_memory))
+
+	if not candidates:
+		return _execute(root, steps)
+
+	dim = max(candidates, key=lambda d: sizes[d])
+	scaling = 0
+	for node, inputs, program, releases in steps:
+		if node is not root:
+			if dim in node.dims:
+				scaling += nbytes(node)
+			else:
+				fixed += nbytes(node)
+
+	per_unit = scaling / float(sizes[dim])
+	if fixed > max_memory:
+		raise MemoryError(
+			'result and intermediates without a {} dim require {} bytes, more than max_memory ({} bytes)'.format(dim, fixed, max_memory))
+
+	step = sizes[dim]
+	if per_unit:
+		step = int(max(1, (max_memory - fixed) // per_unit))
+	if step >= sizes[dim]:
+		return _execute(root, steps)
+
+	# the split dim is not reduced, so every input along it is aligned with 
+	# the result; other dims are left for each piece to align as the full 
+	# graph would (e.g. separate sums over differently labelled regions)
+	leaves = [n for n in order if isinstance(n._value, xr.DataArray) and dim in n._value.dims]
+	aligned = dict(zip(
+		[id(n) for n in leaves], 
+		xr.align(*[n._value for n in leaves], join='inner', copy=False, exclude=set(d for n in leaves for d in n._value.dims if d != dim))))
+
+	out = None
+	coords = {}
+	labels = []
+	for start in range(0, sizes[dim], step):
+		piece = {dim: slice(start, start + step)}
+
+		def replace(node):
+			if id(node) in aligned:
+				value = aligned[id(node)]
+				return Variable(value.isel(piece), symbolic='')
+
+		sub = _rebuild(root, replace)
+		result = _execute(sub, _plan(sub), cache=False).transpose(*root.dims)
+		if out is None:
+			shape = [sizes[d] if d == dim else result.sizes[d] for d in root.dims]
+			out = np.empty(shape, dtype=result.dtype)
+			coords = dict((d, result.indexes[d]) for d in root.dims if d != dim and d in result.indexes)
+		out[tuple(slice(start, start + step) if d == dim else slice(None) for d in root.dims)] = result.values
+		if dim in result.indexes:
+			labels.append(result.indexes[dim])
+
+	if labels:
+		coords[dim] = labels[0].append(labels[1:])
+
+	return xr.DataArray(out, dims=root.dims, coords=coords)
+
+
+def _is_dask(value):
+	# ``chunks`` is slow to look up, and in-memory data is checked often
+	return isinstance(value, xr.DataArray) and not isinstance(value.data, np.ndarray) and value.chunks is not None
+
+
+def _ordered(value, dims):
+	'''
+	``value`` with its dims in the order of ``dims`` (as a view, if needed)
+	'''
+
+	if isinstance(value, xr.DataArray) and value.dims != tuple(dims):
+		return value.transpose(*dims)
+	return value
+
+
+class _MissingValues(Exception):
+	'''
+	Raised by a kernel when missing values (NaN) reach one of its reductions
+	'''
+
+
+def _execute_xarray(root):
+	'''
+	Evaluate ``root`` as a sequence of xarray operations
+
+	Used when some of the inputs are dask-backed, in which case the 
+	operations build a lazy dask graph over the input chunks and the result 
+	is computed with the scheduler set in ``OPTIONS``, and when missing 
+	values reach a reduction (see ``_MissingValues``). The graph should not 
+	be rewritten by ``_optimize`` first: xarray's reductions skip missing 
+	values, which rewritten means and sums would not do in the same way.
+	'''
+
+	results = {}
+	for node in _walk(root):
+		if node._value is not None:
+			results[id(node)] = node._value
+		elif node._op in _REDUCTIONS or node._op == 'mean':
+			results[id(node)] = getattr(results[id(node._args[0])], node._op)(dim=list(_reduced_dims(node)))
+		elif node._op == 'where':
+			results[id(node)] = xr.where(*[results[id(a)] for a in node._args])
+		else:
+			results[id(node)] = _ELEMENTWISE[node._op](*[results[id(a)] for a in node._args])
+
+	result = results[id(root)]
+	if _is_dask(result):
+		result = result.compute(scheduler=OPTIONS['scheduler'])
+	return result
+
+
+_THREAD_POOLS = {}
+
+
+def _thread_pool(threads):
+	if threads not in _THREAD_POOLS:
+		_THREAD_POOLS[threads] = concurrent.futures.ThreadPoolExecutor(threads)
+	return _THREAD_POOLS[threads]
+
+
+def _slice_key(index):
+	return tuple((s.start, s.stop) for s in index)
+
+
+def _batches(kernel, blocks, workers):
+	'''
+	Split ``blocks`` of ``kernel`` into batches to run concurrently
+
+	Returns the batches, and whether each accumulates into an output of its 
+	own. Usually blocks with the same target (the output region they write 
+	or accumulate into) are kept in the same batch, about four batches per 
+	worker, so batches do not race on the output. When a reduction has 
+	fewer targets than there are workers (e.g. the mean over regions of a 
+	time series, where every block adds into the whole output), its blocks 
+	are instead split evenly, one batch per worker, and each batch 
+	accumulates separately (see ``_Kernel.combine``).
+	'''
+
+	groups = collections.OrderedDict()
+	for block in blocks:
+		groups.setdefault(_slice_key(kernel.target(block)), []).append(block)
+	groups = list(groups.values())
+
+	if kernel.accumulate and len(groups) < workers:
+		per_batch = -(-len(blocks) // workers)
+		return [blocks[start:start + per_batch] for start in range(0, len(blocks), per_batch)], True
+
+	per_batch = max(1, len(groups) // (workers * 4))
+	batches = [
+		[b for group in groups[start:start + per_batch] for b in group]
+		for start in range(0, len(groups), per_batch)]
+	return batches, False
+
+
+def _run_threads(kernel, views, out, blocks):
+	'''
+	Run ``blocks`` of ``kernel`` on ``OPTIONS['threads']`` threads
+
+	numpy releases the GIL inside its kernels, so the batches run 
+	concurrently.
+	'''
+
+	threads = OPTIONS['threads']
+	if threads <= 1 or len(blocks) < 2:
+		kernel.run(views, out, blocks)
+		return
+
+	batches, separate = _batches(kernel, blocks, threads)
+	if not separate:
+		for _ in _thread_pool(threads).map(lambda batch: kernel.run(views, out, batch), batches):
+			pass
+		return
+
+	def run(batch):
+		partial = kernel.clear(np.empty_like(out))
+		kernel.run(views, partial, batch)
+		return partial
+
+	for partial in _thread_pool(threads).map(run, batches):
+		kernel.combine(out, partial)
+
+
+# Inputs at least this large are passed to worker processes through shared 
+# memory rather than pickled
+_SHARE_THRESHOLD = 2 ** 20
+
+_SHARED = {}
+_ATTACHED = {}
+_PROCESS_POOLS = {}
+
+
+def _process_pool(processes):
+	if processes not in _PROCESS_POOLS:
+		_PROCESS_POOLS[processes] = concurrent.futures.ProcessPoolExecutor(processes)
+	return _PROCESS_POOLS[processes]
+
+
+@atexit.register
+def _shutdown_process_pools():
+	for pool in _PROCESS_POOLS.values():
+		pool.shutdown()
+
+
+def _share(array):
+	'''
+	Copy ``array`` into shared memory and return a descriptor for ``_attach``
+
+	Each array is only copied once; later kernels reading the same array 
+	(e.g. ``temp`` from the API) reuse the shared copy, which is released 
+	when ``array`` is garbage collected.
+	'''
+
+	key = id(array)
+	if key not in _SHARED:
+		shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+		np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+		_SHARED[key] = shm
+		weakref.finalize(array, _unshare, key)
+	return (_SHARED[key].name, array.shape, array.dtype.str)
+
+
+def _unshare(key):
+	shm = _SHARED.pop(key, None)
+	if shm is not None:
+		shm.close()
+		shm.unlink()
+
+
+def _attach(descriptor):
+	'''
+	View a shared array in a worker process, without copying it
+	'''
+
+	name, shape, dtype = descriptor
+	if name not in _ATTACHED:
+		shm = shared_memory.SharedMemory(name=name)
+		_ATTACHED[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+	return _ATTACHED[name][1]
+
+
+def _detach(keep=()):
+	for name in [n for n in _ATTACHED if n not in keep]:
+		shm, array = _ATTACHED.pop(name)
+		del array
+		shm.close()
+
+
+def _run_shared(task):
+	'''
+	Worker process entry point: run a batch of kernel blocks on shared data
+	'''
+
+	kernel, inputs, output, slot, blocks = task
+	_detach(keep=[data[0] for data, axes, expand in inputs if isinstance(data, tuple)])
+
+	views = []
+	for data, axes, expand in inputs:
+		if isinstance(data, tuple):
+			data = _attach(data)
+		views.append(data.transpose(axes)[expand] if expand else data)
+
+	shm = shared_memory.SharedMemory(name=output[0])
+	out = np.ndarray(output[1], dtype=output[2], buffer=shm.buf)
+	try:
+		kernel.run(views, out if slot is None else out[slot, ...], blocks)
+	finally:
+		del out
+		shm.close()
+
+
+def _run_processes(kernel, specs, out, blocks):
+	'''
+	Run ``blocks`` of ``kernel`` on ``OPTIONS['processes']`` worker processes
+
+	Large inputs are placed in shared memory (see ``_share``) and workers 
+	attach to them and to a shared output, so no array data is pickled. 
+	Returns the filled output, starting from the blocks already in ``out``.
+	'''
+
+	processes = OPTIONS['processes']
+	inputs = [
+		(_share(data) if data.nbytes >= _SHARE_THRESHOLD else data, axes, expand)
+		for data, axes, expand in specs]
+
+	# batches which accumulate separately each get an output of their own, 
+	# as slices of one shared array
+	batches, separate = _batches(kernel, blocks, processes)
+	shape = ((len(batches),) if separate else ()) + out.shape
+	shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * out.itemsize, 1))
+	shared = np.ndarray(shape, dtype=out.dtype, buffer=shm.buf)
+	try:
+		if separate:
+			kernel.clear(shared)
+		else:
+			shared[...] = out
+		output = (shm.name, shape, out.dtype.str)
+		tasks = [(kernel, inputs, output, i if separate else None, b) for i, b in enumerate(batches)]
+		for _ in _process_pool(processes).map(_run_shared, tasks):
+			pass
+		if separate:
+			out = out.copy()
+			for partial in shared:
+				kernel.combine(out, partial)
+		else:
+			out = shared.copy()
+	finally:
+		del shared
+		shm.close()
+		shm.unlink()
+
+	return out
+
+
+# Number of output elements evaluated per block in fused kernels. Sized so a 
+# block of float64 temporaries stays within a typical L2 cache.
+_BLOCK_SIZE = 2 ** 15
+
+
+def _blocks(shape, size=_BLOCK_SIZE, order=None, whole=()):
+	'''
+	Split an array of ``shape`` into blocks of at most ``size`` elements
+
+	``order`` lists the axes from outermost to innermost (C order by 
+	default). Outer axes are stepped one element at a time until the 
+	remaining inner axes fit in a block, and the next axis is chunked. Axes 
+	in ``whole`` must be innermost in ``order`` and are never cut, even if 
+	that makes blocks larger than ``size``.
+	'''
+
+	order = list(range(len(shape))) if order is None else list(order)
+	block = [slice(None)] * len(shape)
+
+	inner = 1
+	k = len(order)
+	while k > 0 and (order[k - 1] in whole or inner * shape[order[k - 1]] <= size):
+		k -= 1
+		inner *= shape[order[k]]
+
+	if k == 0:
+		yield tuple(block)
+		return
+
+	axis = order[k - 1]
+	step = max(1, size // max(inner, 1))
+	for lead in itertools.product(*[range(shape[a]) for a in order[:k - 1]]):
+		for a, i in zip(order, lead):
+			block[a] = slice(i, i + 1)
+		for start in range(0, shape[axis], step):
+			block[axis] = slice(start, min(start + step, shape[axis]))
+			yield tuple(block)
+
+
+def _program_dims(program, present, memo=None):
+	'''
+	Dims spanned by the result of a fused ``program``
+
+	Callers which ask about many parts of one program pass a ``memo`` dict, 
+	so each part is only visited once.
+	'''
+
+	if memo is None:
+		memo = {}
+	if id(program) not in memo:
+		if program[0] == 'input':
+			memo[id(program)] = present[program[1]]
+		elif program[0] in _REDUCTIONS:
+			memo[id(program)] = _program_dims(program[2], present, memo) - set(program[1])
+		else:
+			memo[id(program)] = set().union(*[_program_dims(p, present, memo) for p in program[1:]])
+	return memo[id(program)]
+
+
+def _program_reductions(program):
+	'''
+	Dims reduced by each reduction in ``program``, outermost first
+	'''
+
+	if program[0] == 'input':
+		return []
+	if program[0] in _REDUCTIONS:
+		return [program[1]] + _program_reductions(program[2])
+	return [r for p in program[1:] for r in _program_reductions(p)]
+
+
+def _broadcast_dims(program, present, dims):
+	'''
+	Dims in ``dims`` along which a computed part of ``program`` is broadcast
+
+	Inputs are broadcast for free (as strided views); this finds dims which 
+	an operation's result lacks, e.g. bins for ``ln(GdpPC)`` in betahat.
+	'''
+
+	memo = {}
+	found = set()
+	stack = [program]
+	while stack:
+		program = stack.pop()
+		if program[0] != 'input':
+			found |= set(dims) - _program_dims(program, present, memo)
+			stack.extend(program[2:] if program[0] in _REDUCTIONS else program[1:])
+	return found
+
+
+def _eval_program(program, arrays, present, dims, out=None):
+	'''
+	Evaluate ``program`` on one block of ``arrays`` laid out along ``dims``
+
+	Reductions keep their reduced axes (with length 1) so results always 
+	broadcast against the block. If ``out`` is given, an elementwise result 
+	is written directly into it.
+	'''
+
+	if program[0] == 'input':
+		return arrays[program[1]]
+
+	if program[0] not in _REDUCTIONS:
+		args = [_eval_program(p, arrays, present, dims) for p in program[1:]]
+		if out is not None:
+			return _ELEMENTWISE[program[0]](*args, out=out)
+		return _ELEMENTWISE[program[0]](*args)
+
+	axes = [dims.index(d) for d in program[1]]
+	arg = program[2]
+
+	if program[0] != 'sum' or arg[0] != 'mul':
+		data = np.asarray(_eval_program(arg, arrays, present, dims))
+		count = np.prod([data.shape[a] for a in axes if a < data.ndim])
+		dtype = _accumulator(data.dtype, count) if program[0] == 'sum' else None
+		return _checked(_REDUCTIONS[program[0]].reduce(data, axis=tuple(axes), keepdims=True, dtype=dtype))
+
+	# contract the product directly, so the product itself is never formed. 
+	# Of a product of several factors, the pairs which are cheapest to 
+	# multiply are multiplied first, e.g. temperature by days per bin before 
+	# either is multiplied by coefficients which have a draw dim.
+	factors = []
+	for sub in _factors(arg):
+		data = np.asarray(_eval_program(sub, arrays, present, dims))
+		factors.append((data.reshape(data.shape + (1,) * (len(dims) - data.ndim)), _program_dims(sub, present)))
+	while len(factors) > 2:
+		i, j = _cheapest_pair([f[0].shape for f in factors])
+		product = (factors[i][0] * factors[j][0], factors[i][1] | factors[j][1])
+		factors = [f for k, f in enumerate(factors) if k not in (i, j)] + [product]
+
+	operands = []
+	extent = [1] * len(dims)
+	for data, keep in factors:
+		extent = [max(n, m) for n, m in zip(extent, data.shape)]
+		operands.append(data[tuple(slice(None) if d in keep else 0 for d in dims)])
+		operands.append([i for i, d in enumerate(dims) if d in keep])
+
+	kept = [i for i, d in enumerate(dims) if d in _program_dims(arg, present) and i not in axes]
+	dtype = _accumulator(np.result_type(*operands[::2]), np.prod([extent[a] for a in axes]))
+	# when each operand has output dims the other lacks (e.g. regions for 
+	# climate data and draws for coefficients) the contraction is a matrix 
+	# product, which einsum hands to BLAS when optimizing
+	blas = dtype is None and len(factors) == 2 and all(set(kept) - set(operands[k]) for k in (1, 3))
+	result = _checked(np.einsum(*operands + [kept], dtype=dtype, optimize=blas))
+	shape = [result.shape[kept.index(i)] if i in kept else 1 for i in range(len(dims))]
+	return result.reshape(shape)
+
+
+def _checked(reduced):
+	'''
+	``reduced`` (the result of a reduction), if it has no missing values
+
+	Missing values propagate through sums and maxima, so a NaN here means 
+	one reached the reduction, where xarray would have skipped it. Rather 
+	than slowing every kernel down with NaN-aware reductions, the kernel 
+	stops (see ``_MissingValues``) and the expression is evaluated by xarray.
+	'''
+
+	if reduced.dtype.kind in 'fc' and np.isnan(reduced).any():
+		raise _MissingValues()
+	return reduced
+
+
+def _factors(program):
+	'''
+	Factors of a product in a fused ``program``, flattening nested products
+	'''
+
+	factors = []
+	stack = [program]
+	while stack:
+		program = stack.pop()
+		if program[0] == 'mul':
+			stack.extend(reversed(program[1:]))
+		else:
+			factors.append(program)
+	return factors
+
+
+def _cheapest_pair(shapes):
+	'''
+	Positions of the two factors of ``shapes`` with the smallest product
+	'''
+
+	return min(
+		itertools.combinations(range(len(shapes)), 2), 
+		key=lambda pair: int(np.prod([max(n, m) for n, m in zip(shapes[pair[0]], shapes[pair[1]])])))
+
+
+def _grouped(program, present, layout, shape):
+	'''
+	Dims of the two operands left of the product ``program`` to contract
+
+	Follows the order in which ``_eval_program`` multiplies the factors 
+	(see ``_cheapest_pair``), and also returns the dims of the products it 
+	forms on the way.
+	'''
+
+	factors = [_program_dims(f, present) for f in _factors(program)]
+	products = []
+	while len(factors) > 2:
+		shapes = [tuple(n if d in f else 1 for d, n in zip(layout, shape)) for f in factors]
+		i, j = _cheapest_pair(shapes)
+		products.append(factors[i] | factors[j])
+		factors = [f for k, f in enumerate(factors) if k not in (i, j)] + [products[-1]]
+	return factors, products
+
+
+def _block_size(program, present, layout, shape):
+	'''
+	Elements of ``layout`` per block, for blocks of about ``_BLOCK_SIZE``
+
+	Blocks are sized by their largest temporary array. That is usually a 
+	block of the whole layout, but a contraction never forms the product 
+	it sums, so e.g. when coefficients with a draw dim are contracted over 
+	bins with climate data, a block may span many more draws and bins.
+	'''
+
+	def size(dims):
+		return int(np.prod([n for d, n in zip(layout, shape) if d in dims]))
+
+	largest = 1
+	memo = {}
+	stack = [program]
+	while stack:
+		program = stack.pop()
+		if program[0] == 'input':
+			continue
+		if program[0] in _REDUCTIONS:
+			arg = program[2]
+			if program[0] == 'sum' and arg[0] == 'mul':
+				factors, products = _grouped(arg, present, layout, shape)
+				largest = max([largest] + [size(p) for p in products])
+				stack.extend(_factors(arg))
+			else:
+				largest = max(largest, size(_program_dims(arg, present, memo)))
+				stack.append(arg)
+		else:
+			stack.extend(program[1:])
+		largest = max(largest, size(_program_dims(program, present, memo)))
+
+	return _BLOCK_SIZE * max(1, int(np.prod(shape)) // largest)
+
+
+# Longest sum of single precision numbers which is accumulated in single 
+# precision, where rounding error stays within a few float32 ulps
+_SHORT_SUM = 128
+
+
+def _lowest(dtype):
+	'''
+	Smallest value of ``dtype``, from which maxima are accumulated
+	'''
+
+	if dtype.kind == 'b':
+		return False
+	if dtype.kind in 'iu':
+		return np.iinfo(dtype).min
+	return -np.inf
+
+
+def _accumulator(dtype, count=None):
+	'''
+	Dtype in which to sum ``count`` elements of ``dtype``, or ``None`` to 
+	keep ``dtype``
+
+	Long sums of single precision data are accumulated in double precision, 
+	so float32 mode (see ``ClimateImpactLabDataAPI.configure``) rounds each 
+	result about once rather than losing precision over every element it 
+	sums. Short sums, like the contraction over temperature bins, stay in 
+	single precision, which is twice as fast.
+	'''
+
+	dtype = np.dtype(dtype)
+	if dtype.kind == 'f' and dtype.itemsize < 8 and (count is None or count > _SHORT_SUM):
+		return np.dtype(np.float64)
+	return None
+
+
+class _Kernel(object):
+	'''
+	A fused program bound to the layout of its inputs
+
+	Holds everything needed to evaluate blocks of the output except the 
+	data itself, so it can be shipped to worker processes.
+	'''
+
+	def __init__(self, program, present, layout, kept, accumulate, direct):
+		self.program = program
+		self.present = present
+		self.layout = layout
+		self.kept = kept
+		self.accumulate = accumulate
+		self.direct = direct
+
+	def target(self, block):
+		return tuple(block[i] for i in self.kept)
+
+	def evaluate(self, views, block, out=None):
+		arrays = [
+			view[tuple(s if n > 1 else slice(None) for s, n in zip(block, view.shape))]
+			for view in views]
+		result = _eval_program(self.program, arrays, self.present, self.layout, out=out)
+		result = np.asarray(result).reshape(np.shape(result) + (1,) * (len(self.layout) - np.ndim(result)))
+		return result[tuple(slice(None) if i in self.kept else 0 for i in range(len(self.layout)))]
+
+	def clear(self, out):
+		'''
+		Fill ``out`` with the starting value of the accumulated reduction
+		'''
+
+		out[...] = 0 if self.program[0] == 'sum' else _lowest(out.dtype)
+		return out
+
+	def combine(self, out, partial):
+		'''
+		Accumulate ``partial``, the result of some of the blocks, into ``out``
+		'''
+
+		_REDUCTIONS[self.program[0]](out, partial, out=out)
+
+	def store(self, out, block, result):
+		if self.accumulate:
+			target = self.target(block)
+			out[target] = _REDUCTIONS[self.program[0]](out[target], result)
+		else:
+			out[self.target(block)] = result
+
+	def run(self, views, out, blocks):
+		for block in blocks:
+			if self.direct:
+				self.evaluate(views, block, out=out[self.target(block)])
+			else:
+				self.store(out, block, self.evaluate(views, block))
+
+
+def _layout(program, dims):
+	'''
+	Dims of the arrays a fused ``program`` works on: the output ``dims`` 
+	followed by any dims reduced inside the program
+	'''
+
+	layout = list(dims)
+	for reduced in _program_reductions(program):
+		layout.extend(d for d in reduced if d not in layout)
+	return layout
+
+
+def _schedule(program, present, layout, dims, shape):
+	'''
+	How a fused ``program`` over arrays of ``shape`` is cut into blocks
+
+	Returns ``(kept, accumulate, spanned, order)``: the axes of ``layout`` 
+	which are output dims, the axes reduced at the top of the program which 
+	are accumulated across blocks, the axes which every block spans whole, 
+	and the order of the axes from outermost to innermost (see ``_blocks``).
+	'''
+
+	# dims reduced at the top of the program can be accumulated over several 
+	# blocks; dims reduced anywhere else must be whole within each block
+	accumulate = []
+	if program[0] in _REDUCTIONS:
+		accumulate = [layout.index(d) for d in program[1]]
+		spanned = set(layout.index(d) for r in _program_reductions(program[2]) for d in r)
+		accumulate = [a for a in accumulate if a not in spanned]
+	else:
+		spanned = set(layout.index(d) for r in _program_reductions(program) for d in r)
+
+	# computed parts of the program which lack some output dims are evaluated 
+	# once per block, so those dims are kept innermost, where blocks span them
+	kept = [i for i, d in enumerate(layout) if d in dims]
+	broadcast = _broadcast_dims(program, present, dims)
+	outer = [i for i in kept if i not in spanned and layout[i] not in broadcast]
+	outer += [i for i in kept if i not in spanned and layout[i] in broadcast]
+	order = outer + accumulate + [i for i in range(len(layout)) if i not in outer and i not in accumulate]
+
+	# when reducing to a small result, such as the mean over regions of a 
+	# time series, the reduced dims are streamed through in the outer loop 
+	# and each block spans the whole (cache-resident) output
+	if accumulate and np.prod([shape[i] for i in kept]) <= _BLOCK_SIZE:
+		order = accumulate + outer + [i for i in range(len(layout)) if i not in outer and i not in accumulate]
+
+	return kept, accumulate, spanned, order
+
+
+def _aligned(arrays):
+	'''
+	Whether ``arrays`` already have the same coords along their shared dims
+
+	This is the usual case (e.g. every input indexed by the same regions), 
+	where alignment can be skipped.
+	'''
+
+	indexes = {}
+	sizes = {}
+	for array in arrays:
+		found = array.indexes
+		for d, n in zip(array.dims, array.shape):
+			index = found.get(d)
+			if d not in sizes:
+				sizes[d] = n
+				indexes[d] = index
+			elif n != sizes[d] or (index is None) != (indexes[d] is None):
+				return False
+			elif index is not None and index is not indexes[d] and not index.equals(indexes[d]):
+				return False
+	return True
+
+
+def _run_fused(program, values, dims, out=None):
+	'''
+	Evaluate a fused ``program`` over ``values`` block by block
+
+	DataArray inputs are aligned (without copying) and viewed as numpy arrays 
+	laid out along the output ``dims`` followed by any dims reduced inside the 
+	program (with length-1 axes for dims they lack), so each block of the output is 
+	computed in a single pass through the program without any full-size 
+	intermediates. Blocks are cut along output dims (e.g. adm2) and span 
+	every reduced dim (e.g. bins), except that a reduction at the top of the 
+	program may also be cut and accumulated block by block.
+
+	The result is written into ``out`` if it is given and has the right 
+	shape and a compatible dtype. ``out`` may also be one of the inputs, as 
+	each block is fully computed before it is stored.
+	'''
+
+	reductions = _program_reductions(program)
+	layout = _layout(program, dims)
+
+	arrays = [v for v in values if isinstance(v, xr.DataArray)]
+	if not arrays:
+		return _eval_program(program, values, [set()] * len(values), layout)
+
+	# plain numbers take on the precision of the arrays, as Python scalars do 
+	# in numpy, so they do not promote float32 data to float64
+	precision = np.result_type(*[a.dtype for a in arrays])
+	single = _accumulator(precision) is not None
+
+	aligned = iter(arrays if _aligned(arrays) else xr.align(*arrays, join='inner', copy=False))
+	coords = {}
+	scalars = {}
+	views = []
+	specs = []
+	present = []
+	for v in values:
+		if isinstance(v, xr.DataArray):
+			v = next(aligned)
+			for d in v.dims:
+				if d in v.indexes and d not in coords:
+					coords[d] = v.indexes[d]
+			# scalar coords, e.g. left by selecting a single region, are kept 
+			# unless the inputs disagree on them, as in xarray arithmetic
+			for name, coord in v.coords.items():
+				if coord.ndim == 0:
+					if name in scalars and scalars[name] is not None and not np.array_equal(scalars[name], coord.values):
+						scalars[name] = None
+					else:
+						scalars.setdefault(name, coord.values)
+			axes = tuple(v.dims.index(d) for d in layout if d in v.dims)
+			expand = tuple(slice(None) if d in v.dims else np.newaxis for d in layout)
+			views.append(v.values.transpose(axes)[expand])
+			specs.append((v.values, axes, expand))
+			present.append(set(v.dims))
+		else:
+			v = np.asarray(v)
+			if single and v.dtype.kind in 'biuf':
+				v = v.astype(precision)
+			views.append(v.reshape((1,) * len(layout)))
+			specs.append((views[-1], (), ()))
+			present.append(set())
+
+	shape = tuple(max(view.shape[i] for view in views) for i in range(len(layout)))
+	kept, accumulate, spanned, order = _schedule(program, present, layout, dims, shape)
+
+	# with no reductions, the result of each block is written straight into 
+	# the output rather than into a temporary
+	direct = not reductions and program[0] in _ELEMENTWISE
+
+	kernel = _Kernel(program, present, layout, kept, accumulate, direct)
+
+	blocks = list(_blocks(shape, _block_size(program, present, layout, shape), order=order, whole=spanned))
+	result = kernel.evaluate(views, blocks[0])
+	dtype = precision if single and result.dtype.kind == 'f' else result.dtype
+	size = [shape[i] for i in kept]
+	if out is not None and (list(out.shape) != size or not np.can_cast(dtype, out.dtype, 'same_kind')):
+		out = None
+	if out is None:
+		out = np.empty(size, dtype=dtype)
+
+	# single precision sums across blocks are also accumulated in double 
+	# precision, and rounded when copied to the output at the end
+	total = out
+	if accumulate and program[0] == 'sum' and single:
+		total = np.empty(size, dtype=_accumulator(dtype))
+	if accumulate:
+		kernel.clear(total)
+	kernel.store(total, blocks[0], result)
+
+	if OPTIONS['processes'] > 1 and len(blocks) > 1:
+		total[...] = _run_processes(kernel, specs, total, blocks[1:])
+	else:
+		_run_threads(kernel, views, total, blocks[1:])
+	if total is not out:
+		out[...] = total
+
+	coords = dict((d, coords[d]) for d in dims if d in coords)
+	coords.update((name, value) for name, value in scalars.items() if value is not None and name not in dims)
+	return xr.DataArray(out, dims=dims, coords=coords)
+
+
+def get_random_variable(dims):
+	data = np.random.random(tuple([len(d[1]) for d in dims]))
+	foo = xr.DataArray(data, coords=dims)
+	return foo
+
+
+class ClimateImpactLabDataAPI(object):
+	'''
+	Implements the interface for Climate Impact Lab users
+	'''
+
+	def __init__(self, *args, **kwargs):
+		self.populate_random_data()
+		self._converted = {}
+		self._draws = {}
+
+	def populate_random_data(self):
+		'''
+		Provides dummy versions of the variables we need for this demo
+
+		This method represents work that would be done beforehand. The data in 
+		these variables should already be prepared in netCDF or csvv files. In 
+		the production version, these datasets will also be probabilistic, and 
+		climate variables will also be indexed by climate model.
+		'''
+
+		adm2 = range(1,25000)
+		bins = range(12)
+		time = range(100)
+
+		self.temp = get_random_variable(dims=[('bins', bins), ('adm2', adm2), ('time', time)])
+		self.temp.attrs['symbol'] = 'T'
+		self.temp.attrs['description'] = 'NASA downscaled climate data'
+
+		self.alpha = get_random_variable(dims=[('bins', bins)])
+		self.alpha.attrs['symbol'] = '\\alpha'
+
+		self.gamma1 = get_random_variable(dims=[('bins', bins)])
+		self.gamma1.attrs['symbol'] = '{{\\gamma_1}}'
+
+		self.gamma2 = get_random_variable(dims=[('bins', bins)])
+		self.gamma2.attrs['symbol'] = '{{\\gamma_2}}'
+
+		self.gamma3 = get_random_variable(dims=[('bins', bins)])
+		self.gamma3.attrs['symbol'] = '{{\\gamma_3}}'
+
+		self.avg_days_per_bin = get_random_variable(dims=[('bins', bins), ('adm2', adm2), ('time', time)])
+		self.avg_days_per_bin.attrs['symbol'] = 'AvgDaysPerBin'
+
+		self.gdppc = get_random_variable(dims=[('adm2', adm2), ('time', time)])
+		self.gdppc.attrs['symbol'] = 'GdpPC'
+
+		self.popdens = get_random_variable(dims=[('adm2', adm2), ('time', time)])
+		self.popdens.attrs['symbol'] = 'PopDensity'
+
+		# joint covariance of the regression coefficients, stacked in this 
+		# order, from which ``get_variable`` samples draws
+		self.coefficients = ['alpha', 'gamma1', 'gamma2', 'gamma3']
+		factor = np.random.random((len(self.coefficients) * len(bins),) * 2) * 0.05
+		self.vcv = factor.dot(factor.T)
+
+
+	def get_variable(self, varname, draws=None):
+		'''
+		The actual API call. 
+
+		Parameters
+		----------
+		varname : str
+			Name of the variable.
+
+		draws : int (optional)
+			For regression coefficients, the number of draws to return from 
+			the joint distribution of the coefficients, along a ``draw`` 
+			dim. Coefficients requested with the same number of draws come 
+			from the same joint sample, so expressions combining them (and 
+			anything computed from them) are vectorized over draws. Ignored 
+			for other variables.
+		'''
+
+		if draws is not None and varname in self.coefficients:
+			value = self.get_draws(draws)[varname]
+		else:
+			value = self.__dict__[varname]
+			draws = None
+		if value.dtype.kind == 'f' and value.dtype != OPTIONS['dtype']:
+			if (varname, draws, OPTIONS['dtype']) not in self._converted:
+				self._converted[(varname, draws, OPTIONS['dtype'])] = value.astype(OPTIONS['dtype'])
+			value = self._converted[(varname, draws, OPTIONS['dtype'])]
+		if OPTIONS['backend'] == 'dask':
+			chunks = OPTIONS['chunks'] or {}
+			value = value.chunk(dict((d, c) for d, c in chunks.items() if d in value.dims))
+
+		return Variable(value)
+
+	def get_draws(self, draws):
+		'''
+		Sample ``draws`` draws of the regression coefficients
+
+		Returns a dict of DataArrays with dims ``(draw, bins)`` by 
+		coefficient name. Draws are sampled once per number of draws, from a 
+		fixed seed, so requesting them again returns the same data.
+		'''
+
+		if int(draws) != draws or draws < 1:
+			raise ValueError('draws must be a positive integer, got {!r}'.format(draws))
+
+		if draws not in self._draws:
+			mean = np.concatenate([self.__dict__[c].values for c in self.coefficients])
+			sample = np.random.RandomState(0).multivariate_normal(mean, self.vcv, int(draws))
+			self._draws[draws] = {}
+			for i, name in enumerate(self.coefficients):
+				point = self.__dict__[name]
+				self._draws[draws][name] = xr.DataArray(
+					sample[:, i * point.size:(i + 1) * point.size],
+					dims=('draw',) + point.dims,
+					coords=dict([('draw', np.arange(int(draws)))] + [(d, point.indexes[d]) for d in point.dims]),
+					attrs=point.attrs)
+
+		return self._draws[draws]
+
+	def configure(self, *args, **kwargs):
+		'''
+		Define how you want to use the system
+
+		Parameters
+		----------
+		backend : str (optional)
+			``'numpy'`` (default) to hold variables in memory, or ``'dask'`` 
+			to have ``get_variable`` return chunked, lazily evaluated data 
+			so computations can scale past RAM.
+
+		chunks : dict (optional)
+			Chunk sizes by dim for the dask backend, e.g. ``{'adm2': 5000}``.
+
+		scheduler : str (optional)
+			Local dask scheduler used by ``Variable.compute``: ``'threads'`` 
+			(default), ``'processes'`` or ``'synchronous'``.
+
+		threads : int (optional)
+			Number of threads ``Variable.compute`` uses to evaluate blocks of 
+			in-memory data concurrently (default 1).
+
+		cache_size : int or str (optional)
+			Memory budget for the cache of computed results shared between 
+			Variables, in bytes or as a string such as ``'4GB'`` (default 
+			1GB). Set to 0 to disable the cache.
+
+		disk_cache : str (optional)
+			Directory in which to keep computed results between sessions, or 
+			``None`` (default) to disable. Results are keyed by expression and 
+			by the versions (``uuid`` and ``updated`` attrs) or contents of 
+			the input data, including data requested before it was enabled.
+
+		processes : int (optional)
+			Number of worker processes ``Variable.compute`` uses to evaluate 
+			blocks of in-memory data (default 1). Inputs are shared with the 
+			workers through shared memory. Use this rather than ``threads`` 
+			for operations which hold the GIL. Takes precedence over 
+			``threads`` when both are set.
+
+		dtype : str (optional)
+			Precision in which ``get_variable`` returns data and in which it 
+			is computed: ``'float64'`` (default) or ``'float32'``, which 
+			halves memory use and bandwidth. Sums are still accumulated in 
+			double precision and rounded once, so their results stay within 
+			float32 rounding of the float64 ones.
+		'''
+
+		backend = kwargs.get('backend', OPTIONS['backend'])
+		if backend not in _BACKENDS:
+			raise ValueError('backend must be one of {}, got {!r}'.format(_BACKENDS, backend))
+
+		scheduler = kwargs.get('scheduler', OPTIONS['scheduler'])
+		if scheduler not in _SCHEDULERS:
+			raise ValueError('scheduler must be one of {}, got {!r}'.format(_SCHEDULERS, scheduler))
+
+		dtype = kwargs.get('dtype', OPTIONS['dtype'])
+		if dtype not in _DTYPES:
+			raise ValueError('dtype must be one of {}, got {!r}'.format(_DTYPES, dtype))
+
+		for key in ('threads', 'processes'):
+			workers = kwargs.get(key, OPTIONS[key])
+			if int(workers) != workers or workers < 1:
+				raise ValueError('{} must be a positive integer, got {!r}'.format(key, workers))
+
+		if backend == 'dask':
+			try:
+				import dask.array
+			except ImportError:
+				raise ImportError('the dask backend requires dask to be installed')
+
+		if 'cache_size' in kwargs:
+			kwargs['cache_size'] = _parse_bytes(kwargs['cache_size'])
+			_CACHE.evict(kwargs['cache_size'])
+
+		if kwargs.get('disk_cache') is not None and OPTIONS['disk_cache'] is None:
+			_new_session()
+
+		for key in OPTIONS:
+			if key in kwargs:
+				OPTIONS[key] = kwargs[key]
 
-	def configure(self, *args, **kwargs):
 		print('API configuration updated')
 
 
@@ -0,0 +1,428 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+
+import prototype
+
+
+def variable(data, symbol, **coords):
+	dims = list(coords)
+	value = xr.DataArray(np.asarray(data, dtype=float), dims=dims, coords=coords, attrs={'symbol': symbol})
+	return prototype.Variable(value)
+
+
+@pytest.fixture
+def api(monkeypatch):
+	# the API's dummy data, with a few regions and years rather than all
+	original = prototype.get_random_variable
+	def small(dims):
+		return original([(d, list(coord)[:6] if d in ('adm2', 'time') else coord) for d, coord in dims])
+	monkeypatch.setattr(prototype, 'get_random_variable', small)
+	return prototype.ClimateImpactLabDataAPI()
+
+
+def test_replace_after_compute():
+	bins, adm2 = range(3), range(4)
+	coef = variable(np.random.random(3), 'c', bins=bins)
+	temp = variable(np.random.random((3, 4)), 'T', bins=bins, adm2=adm2)
+	gdp1 = variable(np.random.random(4), 'G', adm2=adm2)
+	gdp2 = variable(np.random.random(4), 'G', adm2=adm2)
+
+	betahat = coef + gdp1.ln()
+	mortality = (betahat * temp).sum('bins')
+	mortality.compute()
+
+	expected = ((coef.value + np.log(gdp2.value)) * temp.value).sum('bins')
+	swapped = mortality.replace(gdp1, gdp2).compute()
+	np.testing.assert_allclose(swapped.transpose(*expected.dims).values, expected.values)
+
+	# only an intermediate was computed
+	betahat = coef + gdp1.ln()
+	mortality = (betahat * temp).sum('bins')
+	betahat.compute()
+	swapped = mortality.replace(gdp1, gdp2).compute()
+	np.testing.assert_allclose(swapped.transpose(*expected.dims).values, expected.values)
+
+	# parts which do not depend on the replaced input keep their result
+	summed = (coef * temp).sum('bins')
+	total = summed + gdp1
+	total.compute()
+	swapped = total.replace(gdp1, gdp2)
+	assert swapped._args[0] is summed
+	np.testing.assert_allclose(swapped.compute().values, (summed.value + gdp2.value).values)
+
+
+def test_sum_counts_aligned_elements():
+	a = variable(np.ones(10), 'A', adm2=range(10))
+	b = variable(np.ones(10), 'B', adm2=range(5, 15))
+	expected = (1 + a.value * b.value).sum('adm2')
+	assert float((1 + a * b).sum('adm2').compute()) == float(expected) == 10
+
+	# same structure, different alignment, so the plan is not reused
+	c = variable(np.ones(10), 'C', adm2=range(2, 12))
+	assert float((1 + a * c).sum('adm2').compute()) == float((1 + a.value * c.value).sum('adm2')) == 16
+
+
+def test_mean_counts_aligned_elements(capsys):
+	a = variable(np.ones((10, 3)), 'A', adm2=range(10), age=range(3))
+	b = variable(np.ones((10, 3)), 'B', adm2=range(5, 15), age=range(3))
+	mean = (a + b).mean('adm2')
+	assert mean.sizes == {'age': 3}
+	np.testing.assert_allclose(mean.compute().values, (a.value + b.value).mean('adm2').values)
+	np.testing.assert_allclose(mean.value.values, 2.0)
+
+	# reported sizes are those after alignment too
+	(a * b).explain()
+	text = capsys.readouterr().out
+	assert 'adm2: 5' in text and 'adm2: 10' not in text
+
+
+def test_inplace_update_with_processes(monkeypatch):
+	monkeypatch.setitem(prototype.OPTIONS, 'processes', 2)
+	shape = (1000, 500)
+	x = variable(np.ones(shape), 'x', a=range(shape[0]), b=range(shape[1]))
+	total = variable(np.ones(shape), 't', a=range(shape[0]), b=range(shape[1]))
+
+	# the accumulator is itself an input to each update, and is shared with 
+	# the workers, so the copy in shared memory must follow its updates
+	for i in range(3):
+		total += x * x
+	np.testing.assert_allclose(total.compute().values, 4)
+
+
+def test_disk_cache_string_coords(tmp_path, monkeypatch):
+	monkeypatch.setitem(prototype.OPTIONS, 'disk_cache', str(tmp_path))
+	a = variable(np.arange(3.), 'A', region=['USA.1', 'USA.2', 'FRA.1'])
+	b = variable(np.ones(3), 'B', region=['USA.1', 'USA.2', 'FRA.1'])
+	result = (a * b + 1).compute()
+
+	# read back from disk, as in a new session
+	cached = prototype._DISK_CACHE.get((a * b + 1).key)
+	assert cached is not None
+	assert list(cached.indexes['region']) == ['USA.1', 'USA.2', 'FRA.1']
+	np.testing.assert_allclose(cached.values, result.values)
+
+
+def test_inplace_division_of_integers():
+	k = prototype.Variable(xr.DataArray(np.arange(4), dims=['adm2'], attrs={'symbol': 'k'}))
+	k /= 2
+	assert k.dtype == np.float64
+	np.testing.assert_allclose(k.compute().values, np.arange(4) / 2)
+
+	k = prototype.Variable(xr.DataArray(np.arange(4), dims=['adm2'], attrs={'symbol': 'k'}))
+	k *= 2
+	assert k.compute().dtype == np.arange(4).dtype
+	np.testing.assert_array_equal(k.value.values, np.arange(4) * 2)
+
+
+def test_inplace_update_with_wider_expression():
+	k = prototype.Variable(xr.DataArray(np.arange(4, dtype=np.int32), dims=['adm2'], attrs={'symbol': 'k'}))
+	j = prototype.Variable(xr.DataArray(np.arange(4, dtype=np.int64) << 40, dims=['adm2'], attrs={'symbol': 'j'}))
+	expected = k.value + j.value * 1
+	k += j * 1
+	assert k.dtype == expected.dtype == np.int64
+	np.testing.assert_array_equal(k.compute().values, expected.values)
+
+
+def test_max_memory_with_misaligned_inputs():
+	a = variable(np.random.random((500, 50)), 'A', adm2=range(500), x=range(50))
+	b = variable(np.random.random((500, 50)), 'B', adm2=range(250, 750), x=range(50))
+	expected = (a.value * b.value).sum('x') + a.value * b.value
+
+	# the result is 250 x 50 after alignment, leaving room to split it in pieces
+	for max_memory in [101000, 100500]:
+		result = ((a * b).sum('x') + a * b).compute(max_memory=max_memory)
+		assert list(result.indexes['adm2']) == list(range(250, 500))
+		np.testing.assert_allclose(result.transpose(*expected.dims).values, expected.values)
+		prototype._CACHE.evict(0)
+
+
+def test_reductions_over_misaligned_inputs():
+	c = variable(np.random.random((10, 3)), 'C', adm2=range(10), x=range(3))
+	d = variable(np.random.random((10, 3)), 'D', adm2=range(5, 15), x=range(3))
+	cv, dv = c.value, d.value
+
+	# each reduction aligns only its own inputs, whether or not they end up 
+	# in the same kernel
+	cases = [
+		(c.sum('adm2') + d.sum('adm2'), cv.sum('adm2') + dv.sum('adm2')),
+		(c.mean('adm2') * d.max('adm2'), cv.mean('adm2') * dv.max('adm2')),
+		((c + d).sum('adm2'), (cv + dv).sum('adm2')),
+		(((c + 1) * d).sum('adm2'), ((cv + 1) * dv).sum('adm2'))]
+	for result, expected in cases:
+		np.testing.assert_allclose(result.compute().transpose(*expected.dims).values, expected.values)
+
+
+def test_compute_keeps_dim_order():
+	a = variable(np.random.random((3, 4, 5)), 'a', bins=range(3), adm2=range(4), time=range(5))
+	b = variable(np.random.random((2, 3)), 'b', draw=range(2), bins=range(3))
+	c = variable(np.random.random(3), 'c', bins=range(3))
+
+	# moving the sum inside reorders the dims of the rewritten graph
+	expected = ((b.value + c.value) * a.value).sum('bins')
+	m = ((b + c) * a).sum('bins')
+	assert m.dims == expected.dims
+	assert m.compute().dims == expected.dims
+	np.testing.assert_allclose(m.value.values, expected.values)
+	assert m.mean('adm2').compute().dims == expected.mean('adm2').dims
+
+	# not from the result cache
+	prototype._CACHE.evict(0)
+	assert [block.dims for block in ((b + c) * a).sum('bins').iter_compute('time', 2)] == [expected.dims] * 3
+	prototype._CACHE.evict(0)
+	assert ((b + c) * a).sum('bins').compute(max_memory=10 ** 6).dims == expected.dims
+
+
+def test_reductions_skip_missing_values():
+	data = np.ones((3, 4))
+	data[1, 2] = np.nan
+	a = variable(data, 'a', bins=range(3), adm2=range(4))
+	b = variable(np.arange(3), 'b', bins=range(3))
+
+	# as xarray's skipna default, for fused sums, contractions, rewritten 
+	# means and sums, and maxima
+	cases = [
+		(a.sum('bins'), a.value.sum('bins')),
+		((a * b).sum('bins'), (a.value * b.value).sum('bins')),
+		(a.mean('adm2'), a.value.mean('adm2')),
+		(((a + b) * 2).sum('bins'), ((a.value + b.value) * 2).sum('bins')),
+		(a.max('bins'), a.value.max('bins')),
+		(a.sum('bins') > 2.5, a.value.sum('bins') > 2.5)]
+	for result, expected in cases:
+		np.testing.assert_array_equal(result.compute().values, expected.values)
+
+	blocks = list((a * b).sum('bins').iter_compute('adm2', 2))
+	np.testing.assert_array_equal(xr.concat(blocks, 'adm2').values, [3, 3, 2, 3])
+
+	total = variable(np.zeros(4), 't', adm2=range(4))
+	total += a.sum('bins')
+	np.testing.assert_array_equal(total.compute().values, [3, 3, 2, 3])
+
+
+def test_max_of_booleans():
+	a = variable([[0.2, 0.9], [0.3, 0.1], [0.4, 0.2]], 'a', bins=range(3), adm2=range(2))
+	expected = (a.value > 0.5).max('bins')
+	result = (a > 0.5).max('bins')
+	assert result.dtype == expected.dtype == bool
+	np.testing.assert_array_equal(result.compute().values, expected.values)
+	assert (a > 0.5).sum('bins').dtype == (a.value > 0.5).sum('bins').dtype
+
+	# over several blocks, accumulated from the smallest value
+	b = variable(np.random.random(100000) * 0.4, 'b', adm2=range(100000))
+	assert not bool((b > 0.5).max('adm2').compute())
+
+
+def test_select_then_update_in_place():
+	y = variable(np.ones(3), 'y', adm2=range(3))
+	y += 1
+	v = y.sel(adm2=slice(0, 1))
+	np.testing.assert_array_equal((v * 2).compute().values, [4, 4])
+	y += 10
+	np.testing.assert_array_equal(y.compute().values, [12, 12, 12])
+	np.testing.assert_array_equal(v.compute().values, [2, 2])
+	np.testing.assert_array_equal((v * 2).compute().values, [4, 4])
+
+
+def test_isel_with_reduced_inputs():
+	a = variable(np.arange(10), 'a', adm2=range(10))
+	c = variable(np.arange(10), 'c', adm2=range(5, 15))
+	expected = (c.value + a.value.sum('adm2')).isel(adm2=7)
+	assert float((c + a.sum('adm2')).isel(adm2=7).compute()) == float(expected) == 52
+
+
+def test_long_expressions():
+	# arithmetic on plain numbers is folded as it is built
+	total = prototype.Variable(0)
+	for i in range(5000):
+		total = total + (i * 0.5 - 1) * 2
+	assert total._op is None
+	assert total.compute() == sum((i * 0.5 - 1) * 2 for i in range(5000))
+	assert type(prototype.Variable(1) * 2.5 + 1) is prototype.Variable
+
+	# keys are computed once per node, across the cuts of a long chain
+	small = [variable(np.random.random(3), 'x', bins=range(3)) for i in range(2000)]
+	total = 0
+	for i, v in enumerate(small):
+		total = total + (v * 2.5 + i) / 3
+	expected = sum((v.value * 2.5 + i) / 3 for i, v in enumerate(small))
+	np.testing.assert_allclose(total.compute().values, expected.values)
+
+
+def test_reductions_to_small_outputs_run_concurrently(monkeypatch):
+	batches = []
+	def spy(kernel, blocks, workers):
+		result = original(kernel, blocks, workers)
+		batches.append(result)
+		return result
+	original = prototype._batches
+	monkeypatch.setattr(prototype, '_batches', spy)
+
+	a = variable(np.random.random((12, 20000, 10)), 'a', bins=range(12), adm2=range(20000), time=range(10))
+	for option in ['threads', 'processes']:
+		monkeypatch.setitem(prototype.OPTIONS, option, 4)
+		for result, expected in [(a.mean('adm2'), a.value.mean('adm2')), (a.max('adm2'), a.value.max('adm2')), (a.sum(), a.value.sum())]:
+			np.testing.assert_allclose(result.compute().values, expected.values)
+			# every block adds into the whole output, so each worker's batch 
+			# accumulates separately
+			split, separate = batches.pop()
+			assert separate and len(split) == 4
+		prototype._CACHE.evict(0)
+		monkeypatch.setitem(prototype.OPTIONS, option, 1)
+
+
+def test_arrays_and_truth_values_are_rejected():
+	b = variable(np.arange(3), 'b', x=range(3))
+	with pytest.raises(TypeError):
+		np.ones(3) * b
+	with pytest.raises(TypeError):
+		np.where(np.ones(3) > 0, b, 0)
+	with pytest.raises(ValueError):
+		if b > 0:
+			pass
+
+
+def test_dask_backend(api, monkeypatch):
+	monkeypatch.setitem(prototype.OPTIONS, 'backend', 'dask')
+	monkeypatch.setitem(prototype.OPTIONS, 'chunks', {'adm2': 4})
+	alpha, gamma1, gdppc, temp = [api.get_variable(name) for name in ['alpha', 'gamma1', 'gdppc', 'temp']]
+	assert temp.value.chunks is not None
+
+	mortality = ((alpha + gamma1 * gdppc.ln()) * temp).sum('bins')
+	expected = ((api.alpha + api.gamma1 * np.log(api.gdppc)) * api.temp).sum('bins')
+	# the mean first, as it would otherwise be taken over the cached result
+	np.testing.assert_allclose(mortality.mean('adm2').compute().values, expected.mean('adm2').values)
+	result = mortality.compute()
+	assert result.dims == mortality.dims
+	assert result.chunks is None
+	np.testing.assert_allclose(result.transpose(*expected.dims).values, expected.values)
+
+
+def test_compute_with_processes(monkeypatch):
+	used = []
+	def spy(*args):
+		used.append(True)
+		return original(*args)
+	original = prototype._run_processes
+	monkeypatch.setattr(prototype, '_run_processes', spy)
+	monkeypatch.setitem(prototype.OPTIONS, 'processes', 2)
+
+	# large inputs go through shared memory, small ones are pickled
+	coef = variable(np.random.random(12), 'c', bins=range(12))
+	temp = variable(np.random.random((12, 2000, 20)), 'T', bins=range(12), adm2=range(2000), time=range(20))
+	gdppc = variable(np.random.random((2000, 20)) + 1, 'G', adm2=range(2000), time=range(20))
+	expected = (coef.value * temp.value + np.log(gdppc.value)).sum('bins')
+	for result, reference in [
+			((coef * temp + gdppc.ln()).sum('bins').mean('adm2'), expected.mean('adm2')),
+			((coef * temp + gdppc.ln()).sum('bins'), expected),
+			(temp * gdppc, temp.value * gdppc.value)]:
+		np.testing.assert_allclose(result.compute().transpose(*reference.dims).values, reference.values)
+		assert used
+		del used[:]
+
+
+def test_iter_compute():
+	coef = variable(np.random.random(12), 'c', bins=range(12))
+	temp = variable(np.random.random((12, 50, 23)), 'T', bins=range(12), adm2=range(50), time=range(2000, 2023))
+
+	# the mean over time does not have the dim, so it is computed once
+	anomaly = (coef * (temp - temp.mean('time'))).sum('bins')
+	expected = (coef.value * (temp.value - temp.value.mean('time'))).sum('bins')
+	blocks = list(anomaly.iter_compute('time', chunk=5))
+	assert [b.sizes['time'] for b in blocks] == [5, 5, 5, 5, 3]
+	assert all(b.dims == anomaly.dims for b in blocks)
+	result = xr.concat(blocks, dim='time')
+	assert list(result.indexes['time']) == list(range(2000, 2023))
+	np.testing.assert_allclose(result.transpose(*expected.dims).values, expected.values)
+
+	# blocks of a computed result are taken from it
+	anomaly.compute()
+	result = xr.concat(list(anomaly.iter_compute('time', chunk=10)), dim='time')
+	np.testing.assert_allclose(result.transpose(*expected.dims).values, expected.values)
+
+
+def read_zarr_array(path):
+	# zarr is not required, and the arrays written are uncompressed, so the 
+	# chunks are read back directly
+	with open(os.path.join(path, '.zarray')) as f:
+		meta = json.load(f)
+	with open(os.path.join(path, '.zattrs')) as f:
+		dims = json.load(f)['_ARRAY_DIMENSIONS']
+	chunks = meta['chunks']
+	shape = meta['shape']
+	padded = np.zeros([-(-n // c) * c for n, c in zip(shape, chunks)], dtype=meta['dtype'])
+	for name in os.listdir(path):
+		if not name.startswith('.'):
+			position = [int(i) for i in name.split('.')]
+			chunk = np.fromfile(os.path.join(path, name), dtype=meta['dtype']).reshape(chunks)
+			padded[tuple(slice(i * c, (i + 1) * c) for i, c in zip(position, chunks))] = chunk
+	return dims, padded[tuple(slice(0, n) for n in shape)].reshape(shape)
+
+
+def test_to_store(tmp_path):
+	coef = variable(np.random.random(12), 'c', bins=range(12))
+	temp = variable(np.random.random((12, 50, 23)), 'T', bins=range(12), adm2=range(50), time=range(2000, 2023))
+	mortality = (coef * temp).sum('bins') + 1
+	expected = (coef.value * temp.value).sum('bins') + 1
+
+	for name, chunks in [('split', {'adm2': 8, 'time': 5}), ('default', None)]:
+		path = str(tmp_path / name)
+		mortality.to_store(path, chunks=chunks)
+		dims, values = read_zarr_array(os.path.join(path, prototype._STORE_NAME))
+		assert dims == list(mortality.dims)
+		np.testing.assert_allclose(values, expected.transpose(*dims).values)
+		for dim in dims:
+			assert list(read_zarr_array(os.path.join(path, dim))[1]) == list(expected.indexes[dim])
+
+
+def test_numpy_functions():
+	temp = variable(np.random.random((12, 50)) - 0.5, 'T', bins=range(12), adm2=range(50))
+	gdppc = variable(np.random.random(50) + 1, 'G', adm2=range(50))
+
+	for result, expected in [
+			(np.log(gdppc) * temp, np.log(gdppc.value) * temp.value),
+			(np.maximum(temp, 0) + np.sqrt(gdppc), np.maximum(temp.value, 0) + np.sqrt(gdppc.value)),
+			(np.where(temp > 0, temp, np.exp(temp)), xr.where(temp.value > 0, temp.value, np.exp(temp.value))),
+			(np.sum(temp * gdppc, axis=0), (temp.value * gdppc.value).sum('bins')),
+			(np.mean(temp), temp.value.mean()),
+			(np.max(temp, axis=1), temp.value.max('adm2'))]:
+		assert isinstance(result, prototype.Variable)
+		computed = result.compute()
+		np.testing.assert_allclose(computed.transpose(*expected.dims).values, expected.values)
+
+
+def test_draws_match_a_loop_over_draws(api):
+	draws = 5
+	alpha, gamma1, gamma2 = [api.get_variable(name, draws=draws) for name in ['alpha', 'gamma1', 'gamma2']]
+	gdppc, popdens, temp = [api.get_variable(name) for name in ['gdppc', 'popdens', 'temp']]
+	assert alpha.dims == ('draw', 'bins')
+
+	mortality = ((alpha + gamma1 * gdppc.ln() + gamma2 * popdens.ln()) * temp).sum('bins')
+	result = mortality.compute()
+	assert result.sizes['draw'] == draws
+
+	sample = api.get_draws(draws)
+	for i in range(draws):
+		a, g1, g2 = [sample[name].isel(draw=i) for name in ['alpha', 'gamma1', 'gamma2']]
+		expected = ((a + g1 * np.log(api.gdppc) + g2 * np.log(api.popdens)) * api.temp).sum('bins')
+		np.testing.assert_allclose(result.isel(draw=i).transpose(*expected.dims).values, expected.values)
+
+	# the draws are sampled once, so they are the same when requested again
+	np.testing.assert_array_equal(api.get_variable('alpha', draws=draws).value.values, alpha.value.values)
+
+
+def test_enable_disk_cache_after_keying(api, tmp_path, monkeypatch):
+	monkeypatch.setitem(prototype.OPTIONS, 'disk_cache', None)
+	a = variable(np.arange(3.), 'A', x=range(3))
+	b = variable(np.ones(3), 'B', x=range(3))
+	assert (a * b).key.startswith('session-')
+
+	# inputs keyed before the disk cache was enabled are keyed by content 
+	# once it is, so results computed from them are saved
+	api.configure(disk_cache=str(tmp_path))
+	total = a * b + 1
+	assert not total.key.startswith('session-')
+	result = total.compute()
+	np.testing.assert_allclose(prototype._DISK_CACHE.get(total.key).values, result.values)